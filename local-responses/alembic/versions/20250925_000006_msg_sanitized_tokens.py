@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20250925_000006_msg_sanitized_tokens'
+down_revision = '20250923_000004'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # nullable: existing rows stay NULL and are measured on read until rewritten
+    with op.batch_alter_table('messages') as b:
+        b.add_column(sa.Column('sanitized_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('messages') as b:
+        b.drop_column('sanitized_tokens')
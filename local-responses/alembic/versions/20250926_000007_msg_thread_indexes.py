@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '20250926_000007_msg_thread_indexes'
+down_revision = '20250925_000006_msg_sanitized_tokens'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.create_index('ix_messages_thread_created', 'messages', ['thread_id', 'created_at'], if_not_exists=True)
+    op.create_index('ix_messages_thread_role_created', 'messages', ['thread_id', 'role', 'created_at'], if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_thread_role_created', table_name='messages')
+    op.drop_index('ix_messages_thread_created', table_name='messages')
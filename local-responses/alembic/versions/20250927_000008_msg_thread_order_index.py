@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '20250927_000008_msg_thread_order_index'
+down_revision = '20250926_000007_msg_thread_indexes'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # (thread_id, created_at, id) covers the (created_at, id) keyset cut; the old index is its prefix
+    op.create_index('ix_messages_thread_order', 'messages', ['thread_id', 'created_at', 'id'], if_not_exists=True)
+    op.drop_index('ix_messages_thread_created', table_name='messages', if_exists=True)
+
+
+def downgrade() -> None:
+    op.create_index('ix_messages_thread_created', 'messages', ['thread_id', 'created_at'], if_not_exists=True)
+    op.drop_index('ix_messages_thread_order', table_name='messages')
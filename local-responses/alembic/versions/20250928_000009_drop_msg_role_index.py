@@ -0,0 +1,17 @@
+from __future__ import annotations
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '20250928_000009_drop_msg_role_index'
+down_revision = '20250927_000008_msg_thread_order_index'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # role filters ride on ix_messages_thread_order (thread_id, created_at, id); no query needs role second
+    op.drop_index('ix_messages_thread_role_created', table_name='messages', if_exists=True)
+
+
+def downgrade() -> None:
+    op.create_index('ix_messages_thread_role_created', 'messages', ['thread_id', 'role', 'created_at'], if_not_exists=True)
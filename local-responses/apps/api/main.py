@@ -7,23 +7,23 @@ import os
 import time
 import logging
 import math
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from decimal import Decimal
 from pathlib import Path
 from typing import Any, Dict, Literal, Optional
 from uuid import uuid4
 import uuid
 
 import httpx
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
-from packages.core.settings import get_settings
+from packages.core.settings import AppSettings, get_settings
 from packages.core.logging import configure_logging, request_logging_middleware
-from packages.core.pricing import price_for
+from packages.core.pricing import cost_for, price_for
 from packages.providers.lmstudio import get_lmstudio_provider
 from packages.providers.lmstudio_model_info import fetch_model_info
 from packages.providers import lmstudio_tokens
@@ -31,11 +31,12 @@ from packages.orchestration.redactor import redact_fragment, safe_profile_output
 from packages.orchestration.context_builder import assemble_context
 from packages.orchestration.summarizer import try_autosummarize
 from packages.storage.repo import (
-    append_message,
+    append_message_async,
     create_thread,
     fetch_context as repo_fetch_context,
-    save_response,
+    save_response_async,
     session_scope,
+    request_session_scope,
     get_profile as repo_get_profile,
     save_profile as repo_save_profile,
     get_thread_messages_for_l1,
@@ -43,7 +44,7 @@ from packages.storage.repo import (
     get_l3_for_thread,
 )
 from packages.storage.models import Message, Thread
-from packages.utils.tokens import approx_tokens, profile_text_view, approx_tokens_messages
+from packages.utils.tokens import approx_tokens, json_dumps, load_bpe_encoder, profile_text_view, approx_tokens_messages
 from packages.orchestration.memory_manager import update_memory
 from packages.orchestration.stream_handlers import ToolCallAssembler
 from packages.orchestration.after_reply import normalize_after_reply
@@ -51,7 +52,15 @@ from packages.orchestration.after_reply import normalize_after_reply
 settings = get_settings()
 configure_logging(level=settings.log_level)
 
-app = FastAPI(title=settings.app_name, version="0.0.1")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # BPE ranks load off the event loop before the first request counts tokens
+    await load_bpe_encoder()
+    yield
+
+
+app = FastAPI(title=settings.app_name, version="0.0.1", lifespan=lifespan)
 log_lm = logging.getLogger("app.lmstudio")
 
 # CORS
@@ -68,6 +77,14 @@ app.add_middleware(
 # Request/response logging middleware
 app.middleware("http")(request_logging_middleware)
 
+
+# DB-only read endpoints share one DB session/transaction per request (opt-in dependency).
+# Handlers that call LM Studio or stream, and all writes, keep per-helper transactions: a
+# session held across network calls would pin a connection/transaction for their duration.
+async def shared_db_session():
+    with request_session_scope():
+        yield
+
 # Optionally serve built web UI if exists
 web_dist = Path(__file__).resolve().parents[2] / "apps" / "web" / "dist"
 if web_dist.exists():
@@ -104,7 +121,7 @@ class ProfileOut(ProfileIn):
     core_cap: int
 
 
-@app.get("/profile")
+@app.get("/profile", dependencies=[Depends(shared_db_session)])
 async def get_profile() -> JSONResponse:
     row = repo_get_profile()
     # Build dict and normalize JSON-like fields
@@ -179,8 +196,8 @@ async def health() -> Dict[str, Any]:
     return {"status": "ok", "time": datetime.now(timezone.utc).isoformat()}
 
 
-@app.get("/config")
-async def config() -> JSONResponse:
+@app.get("/config", dependencies=[Depends(shared_db_session)])
+async def config(settings: AppSettings = Depends(get_settings)) -> JSONResponse:
     db_dialect = settings.db_dialect
     # profile slice and tokens
     prof_row = repo_get_profile()
@@ -228,7 +245,7 @@ async def config() -> JSONResponse:
 
 
 @app.get("/providers/lmstudio/health")
-async def lmstudio_health() -> JSONResponse:
+async def lmstudio_health(settings: AppSettings = Depends(get_settings)) -> JSONResponse:
     if not settings.lmstudio_base_url:
         return JSONResponse(status_code=200, content={"status": "error", "detail": "not configured"})
     url = str(settings.lmstudio_base_url).rstrip("/") + "/v1/models"
@@ -242,7 +259,7 @@ async def lmstudio_health() -> JSONResponse:
 
 
 @app.get("/providers/lmstudio/models")
-async def lmstudio_models() -> JSONResponse:
+async def lmstudio_models(settings: AppSettings = Depends(get_settings)) -> JSONResponse:
     if not settings.lmstudio_base_url:
         return JSONResponse(status_code=200, content={"data": [], "error": "not configured"})
     url = str(settings.lmstudio_base_url).rstrip("/") + "/v1/models"
@@ -258,7 +275,7 @@ async def lmstudio_models() -> JSONResponse:
 
 
 @app.get("/providers/lmstudio/models/v0")
-async def lmstudio_models_v0() -> JSONResponse:
+async def lmstudio_models_v0(settings: AppSettings = Depends(get_settings)) -> JSONResponse:
     if not settings.lmstudio_base_url:
         return JSONResponse(status_code=200, content={"data": [], "error": "not configured"})
     url = str(settings.lmstudio_base_url).rstrip("/") + "/api/v0/models"
@@ -273,8 +290,7 @@ async def lmstudio_models_v0() -> JSONResponse:
 
 
 @app.get("/providers/lmstudio/context-length")
-async def lmstudio_context_length(model: str) -> JSONResponse:
-    settings_local = settings
+async def lmstudio_context_length(model: str, settings_local: AppSettings = Depends(get_settings)) -> JSONResponse:
     mid = model.split(":", 1)[1] if model.startswith("lm:") else model
     info = await fetch_model_info(mid)
     ttl = settings_local.ctx_model_info_ttl_sec
@@ -302,7 +318,7 @@ async def lmstudio_context_length(model: str) -> JSONResponse:
     })
 
 
-@app.get("/threads/{thread_id}")
+@app.get("/threads/{thread_id}", dependencies=[Depends(shared_db_session)])
 async def get_thread(thread_id: str) -> JSONResponse:
     with session_scope() as s:
         t = s.get(Thread, thread_id)
@@ -322,7 +338,7 @@ async def get_thread(thread_id: str) -> JSONResponse:
 
 
 @app.post("/threads/{thread_id}/summary/rebuild")
-async def rebuild_summary(thread_id: str) -> JSONResponse:
+async def rebuild_summary(thread_id: str, settings: AppSettings = Depends(get_settings)) -> JSONResponse:
     # schedule manual rebuild if not already running and debounce allows
     with session_scope() as s:
         t = s.get(Thread, thread_id)
@@ -348,8 +364,8 @@ async def rebuild_summary(thread_id: str) -> JSONResponse:
     return JSONResponse(status_code=202, content={"scheduled": True, "reason": "manual"})
 
 
-@app.get("/threads/{thread_id}/messages")
-async def get_thread_messages(thread_id: str) -> JSONResponse:
+@app.get("/threads/{thread_id}/messages", dependencies=[Depends(shared_db_session)])
+async def get_thread_messages(thread_id: str, settings: AppSettings = Depends(get_settings)) -> JSONResponse:
     with session_scope() as s:
         t = s.get(Thread, thread_id)
         q = (
@@ -375,7 +391,7 @@ async def get_thread_messages(thread_id: str) -> JSONResponse:
         "context": ctx,
     })
 
-@app.get("/threads/{thread_id}/memory")
+@app.get("/threads/{thread_id}/memory", dependencies=[Depends(shared_db_session)])
 async def get_thread_memory(thread_id: str) -> JSONResponse:
     # Ensure thread exists
     with session_scope() as s:
@@ -488,7 +504,7 @@ class ResponsesResponse(BaseModel):
     metadata: Optional[Dict[str, Any]] = None
 
 @app.post("/providers/lmstudio/tokenize")
-async def tokenize(req: TokenizeReq):
+async def tokenize(req: TokenizeReq, settings: AppSettings = Depends(get_settings)):
     if settings.TOKEN_COUNT_MODE != "proxy":
         return {"error": "TOKEN_COUNT_MODE is not 'proxy'"}
     if req.messages:
@@ -507,14 +523,19 @@ async def send_sse_meta(queue, payload: Dict[str, Any]):
     await queue.put(await _sse_format("meta", payload))
 
 @app.post("/responses")
-async def create_response(request: Request, req: ResponsesRequest, stream: bool = False):
+async def create_response(
+    request: Request,
+    req: ResponsesRequest,
+    stream: bool = False,
+    settings: AppSettings = Depends(get_settings),
+):
     model = req.model
     provider_model = model.split(":", 1)[1] if isinstance(model, str) and model.startswith("lm:") else model
 
     if not settings.lmstudio_base_url:
         raise HTTPException(status_code=503, detail="LM Studio base URL is not configured")
 
-    provider = get_lmstudio_provider()
+    provider = get_lmstudio_provider(settings)
     provider_info = {"name": "lmstudio", "base_url": str(settings.lmstudio_base_url)}
 
     # Define price per 1k tokens once for both modes
@@ -523,7 +544,7 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
     thread_id = _ensure_thread(req)
 
     # Save user message early for pairing and UI echo
-    saved_user = append_message(thread_id, "user", req.input)
+    saved_user = await append_message_async(thread_id, "user", req.input)
     current_user_id = saved_user.id if saved_user else None
 
     # streaming early echo will be handled in stream branch
@@ -614,7 +635,7 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
             raise HTTPException(status_code=502, detail=f"Failed to reach LM Studio: {e}")
         usage_vals = usage_dict or {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
         # Persist assistant message first
-        assistant_msg = append_message(thread_id, "assistant", text, tokens=usage_vals)
+        assistant_msg = await append_message_async(thread_id, "assistant", text, tokens=usage_vals)
         # HF-31B post-reply normalization (eager cascade) — recompute L1/L2/L3 & compaction
         try:
             caps = (metadata.get("context_assembly", {}).get("caps")
@@ -642,7 +663,7 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
             sc["l2_to_l3"] += norm_result.get("summary_counters", {}).get("l2_to_l3", 0)
             # refresh includes after normalization
             from packages.storage import repo as repo_mod
-            st_inst = get_settings()
+            st_inst = settings
             l2_records_norm = repo_mod.get_l2_for_thread(thread_id, limit=getattr(st_inst, 'L2_FETCH_LIMIT', 500))
             l3_records_norm = repo_mod.get_l3_for_thread(thread_id, limit=getattr(st_inst, 'L3_FETCH_LIMIT', 200))
             inc = asm.setdefault("includes", {})
@@ -650,7 +671,7 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
             inc["l3_ids"] = [r.id for r in l3_records_norm]
         except Exception:
             pass
-        cost = Decimal(((usage_vals.get("total_tokens", 0)) / 1000) * float(price_1k)).quantize(Decimal("0.000001"))
+        cost = cost_for(usage_vals.get("total_tokens", 0), price_1k)
         out_item = ResponsesOutputItem(content=[{"type": "output_text", "text": text}])
         meta_common = {"thread_id": thread_id, "context_budget": metadata["context_budget"], "context_assembly": metadata["context_assembly"]}
         resp = ResponsesResponse(
@@ -663,11 +684,11 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
             provider=provider_info,
             metadata=meta_common | {"provider_request": provider_request, "tool_calls": []} | (req.metadata or {}),
         )
-        save_response(
+        await save_response_async(
             resp_id=resp.id,
             thread_id=thread_id,
-            request_json=json.dumps(req.model_dump(), ensure_ascii=False),
-            response_json=json.dumps(resp.model_dump(), ensure_ascii=False),
+            request_json=json_dumps(req.model_dump()),
+            response_json=json_dumps(resp.model_dump()),
             status=resp.status,
             model=provider_model,
             provider_name=provider_info["name"],
@@ -708,13 +729,15 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
         collected: list[str] = []
         assembler = ToolCallAssembler()
 
+        hb_sec = float(settings.responses_heartbeat_sec)
+
         async def heartbeat_loop():
             try:
                 while not done_event.is_set():
-                    await asyncio.sleep(10)
+                    await asyncio.sleep(hb_sec)
                     if cancel_flag["cancelled"]:
                         break
-                    if time.monotonic() - last_delta_ts > 8:
+                    if time.monotonic() - last_delta_ts > hb_sec * 0.8:
                         await queue.put(await _sse_format("ping", {"ts": datetime.now(timezone.utc).isoformat()}))
             except asyncio.CancelledError:
                 pass
@@ -765,7 +788,7 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
 
             final_text = "".join(collected)
             usage_vals = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
-            append_message(thread_id, "assistant", final_text, tokens=usage_vals)
+            await append_message_async(thread_id, "assistant", final_text, tokens=usage_vals)
             # Post-reply normalization HF-31B before final meta events
             try:
                 caps = metadata.get("context_assembly", {}).get("caps") or assembled.get("stats", {}).get("caps") or {"l1":0,"l2":0,"l3":0}
@@ -785,7 +808,7 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
                 sc["l1_to_l2"] += norm_result.get("summary_counters", {}).get("l1_to_l2", 0)
                 sc["l2_to_l3"] += norm_result.get("summary_counters", {}).get("l2_to_l3", 0)
                 from packages.storage import repo as repo_mod
-                st_inst = get_settings()
+                st_inst = settings
                 l2_records_norm = repo_mod.get_l2_for_thread(thread_id, limit=getattr(st_inst, 'L2_FETCH_LIMIT', 500))
                 l3_records_norm = repo_mod.get_l3_for_thread(thread_id, limit=getattr(st_inst, 'L3_FETCH_LIMIT', 200))
                 inc = asm.setdefault("includes", {})
@@ -794,9 +817,9 @@ async def create_response(request: Request, req: ResponsesRequest, stream: bool
                 await queue.put(await _sse_format("meta.update", {"summary_counters": sc, "includes": inc, "compaction_steps": asm.get("compaction_steps", [])}))
             except Exception:
                 pass
-            cost = Decimal(((usage_vals.get("total_tokens", 0)) / 1000) * float(price_1k)).quantize(Decimal("0.000001"))
-            response_json = json.dumps({"id": resp_id, "object": "response", "created": created, "model": provider_model, "status": "completed", "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": final_text}]}], "usage": usage_vals, "provider": provider_info, "metadata": {"thread_id": thread_id}}, ensure_ascii=False)
-            save_response(resp_id=resp_id, thread_id=thread_id, request_json=json.dumps(req.model_dump(), ensure_ascii=False), response_json=response_json, status="cancelled" if cancel_flag["cancelled"] else "completed", model=provider_model, provider_name=provider_info["name"], provider_base_url=provider_info["base_url"], usage=usage_vals, cost=cost)
+            cost = cost_for(usage_vals.get("total_tokens", 0), price_1k)
+            response_json = json_dumps({"id": resp_id, "object": "response", "created": created, "model": provider_model, "status": "completed", "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": final_text}]}], "usage": usage_vals, "provider": provider_info, "metadata": {"thread_id": thread_id}})
+            await save_response_async(resp_id=resp_id, thread_id=thread_id, request_json=json_dumps(req.model_dump()), response_json=response_json, status="cancelled" if cancel_flag["cancelled"] else "completed", model=provider_model, provider_name=provider_info["name"], provider_base_url=provider_info["base_url"], usage=usage_vals, cost=cost)
             try:
                 tool_results_tokens = 0
                 mem = await update_memory(thread_id, assembled.get("context_budget", {}), tool_results_tokens, int(time.time()))
@@ -1,6 +1,7 @@
 # packages/core/pricing.py
 from __future__ import annotations
 
+from decimal import Decimal
 from typing import Dict
 
 PRICES: Dict[str, Dict[str, float]] = {
@@ -22,3 +23,14 @@ def price_for(provider: str, model: str, overrides: Dict[str, float] | None = No
         if key_def in overrides:
             return overrides[key_def]
     return base
+
+
+def to_micros(price: float) -> int:
+    """Price per 1k tokens as integer millionths."""
+    return int(round(float(price) * 1_000_000))
+
+
+def cost_for(total_tokens: int, price_per_1k: float) -> Decimal:
+    """Cost with 6 decimal places, integer fixed-point (half-up on the last place)."""
+    cost_micros = (int(total_tokens or 0) * to_micros(price_per_1k) + 500) // 1000
+    return Decimal(cost_micros).scaleb(-6)
@@ -1,6 +1,7 @@
 # packages/core/settings.py
 from __future__ import annotations
 
+from dataclasses import dataclass
 from functools import lru_cache
 from typing import Any, Dict, Optional, Union, Tuple
 
@@ -19,11 +20,19 @@ class AppSettings(BaseSettings):
     log_level: str = "INFO"
     log_format: str = Field(default="json", validation_alias="LOG_FORMAT")
     db_url: str = "sqlite:///data/app.db"
+    # Connection pool (non-SQLite dialects; SQLite keeps SQLAlchemy's per-file defaults)
+    db_pool_size: int = Field(default=10, validation_alias="DB_POOL_SIZE")
+    db_max_overflow: int = Field(default=20, validation_alias="DB_MAX_OVERFLOW")
+    db_pool_timeout: int = Field(default=30, validation_alias="DB_POOL_TIMEOUT")
+    db_pool_recycle: int = Field(default=1800, validation_alias="DB_POOL_RECYCLE")
+    db_pool_pre_ping: bool = Field(default=True, validation_alias="DB_POOL_PRE_PING")
 
     # Provider endpoints
     lmstudio_base_url: Optional[Union[AnyUrl, str]] = Field(
         default="http://192.168.0.111:1234", validation_alias="LMSTUDIO_BASE_URL"
     )
+    # SSE /responses?stream=true: heartbeat tick; a ping goes out after 0.8 tick without deltas
+    responses_heartbeat_sec: float = Field(default=10.0, validation_alias="RESPONSES_HEARTBEAT_SEC")
 
     # Context manager
     ctx_max_input_tokens: int = Field(default=2048, validation_alias="CTX_MAX_INPUT_TOKENS")
@@ -78,6 +87,9 @@ class AppSettings(BaseSettings):
     price_per_1k_default: float = Field(default=0.0, validation_alias="PRICE_PER_1K_DEFAULT")
     price_overrides: Dict[str, float] = Field(default_factory=dict)
 
+    # Tool runs: hash of canonical args used as the cache key (sha256|blake2b|sha1|any hashlib name)
+    TOOL_ARGS_HASH_ALGO: str = Field(default="sha256", validation_alias="TOOL_ARGS_HASH_ALGO")
+
     # Token counting proxy
     TOKEN_COUNT_MODE: str = Field(default="proxy", validation_alias="TOKEN_COUNT_MODE")  # "proxy"|"approx"|"provider_usage"
     TOKEN_CACHE_TTL_SEC: int = Field(default=300, validation_alias="TOKEN_CACHE_TTL_SEC")
@@ -130,3 +142,32 @@ def get_settings() -> AppSettings:
     s = AppSettings()
     s.price_overrides = overrides
     return s
+
+
+@dataclass(frozen=True, slots=True)
+class HotSettings:
+    """Frozen copy of the settings read on every request (slot access instead of pydantic attrs)."""
+    mem_l1_share: float
+    mem_l2_share: float
+    mem_l3_share: float
+    mem_tools_max_share: float
+
+
+_HOT_CACHE: Tuple[Optional[AppSettings], Optional[HotSettings]] = (None, None)
+
+
+def get_settings_frozen() -> HotSettings:
+    """HotSettings for the current get_settings() instance; rebuilt when that instance changes
+    (get_settings.cache_clear() in tests/reloads), so it never goes stale."""
+    global _HOT_CACHE
+    st = get_settings()
+    src, hot = _HOT_CACHE
+    if src is not st or hot is None:
+        hot = HotSettings(
+            mem_l1_share=st.mem_l1_share,
+            mem_l2_share=st.mem_l2_share,
+            mem_l3_share=st.mem_l3_share,
+            mem_tools_max_share=st.mem_tools_max_share,
+        )
+        _HOT_CACHE = (st, hot)
+    return hot
@@ -1,14 +1,27 @@
 from __future__ import annotations
 
 import math
+import time
 import asyncio
-from typing import Any, Dict, Optional
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
 
 from packages.core.settings import get_settings
 from packages.providers.lmstudio_cache import get_cached, set_cached, _get_lock
 from packages.providers.lmstudio_model_info import fetch_model_info
 
 
+# (model_id, max_output_tokens, core_tokens, core_cap) -> (settings, expires_at, budgets).
+# Only budgets built on a loaded context window are kept; the settings object is held
+# so a rebuilt settings instance never hits a stale entry.
+_BUDGET_CACHE: "OrderedDict[Tuple[str, Optional[int], int, int], Tuple[Any, float, Dict[str, Any]]]" = OrderedDict()
+_BUDGET_CACHE_MAX = 256
+
+
+def clear_budget_cache() -> None:
+    _BUDGET_CACHE.clear()
+
+
 def _strip_provider_prefix(model_id: str) -> str:
     return model_id.split(":", 1)[1] if model_id.startswith("lm:") else model_id
 
@@ -40,6 +53,13 @@ async def _get_model_info_cached(model_id: str) -> Dict[str, Any]:
 
 async def compute_budgets(model_id: str, max_output_tokens: Optional[int], core_tokens: int, core_cap: int, settings=None) -> Dict[str, Any]:
     settings = settings or get_settings()
+    key = (model_id, max_output_tokens, int(core_tokens), int(core_cap))
+    hit = _BUDGET_CACHE.get(key)
+    if hit is not None:
+        if hit[0] is settings and hit[1] > time.time():
+            _BUDGET_CACHE.move_to_end(key)
+            return dict(hit[2])
+        _BUDGET_CACHE.pop(key, None)
     info = await _get_model_info_cached(model_id)
 
     # If model is not loaded yet, wait briefly for it to load to get accurate loaded_context_length
@@ -81,7 +101,7 @@ async def compute_budgets(model_id: str, max_output_tokens: Optional[int], core_
     core_reserved = min(int(core_cap) + core_sys_pad, max(0, B_total_in))
     B_work = max(0, B_total_in - core_reserved)
 
-    return {
+    out = {
         "model_id": _strip_provider_prefix(model_id),
         "source": source,
         "C_eff": C_base,  # kept for backward-compat in UI/tests
@@ -98,3 +118,8 @@ async def compute_budgets(model_id: str, max_output_tokens: Optional[int], core_
         "B_work": B_work,
         "effective_max_output_tokens": R_out,
     }
+    if C_loaded is not None and info.get("state") == "loaded":
+        _BUDGET_CACHE[key] = (settings, time.time() + int(settings.ctx_model_info_ttl_sec), dict(out))
+        if len(_BUDGET_CACHE) > _BUDGET_CACHE_MAX:
+            _BUDGET_CACHE.popitem(last=False)
+    return out
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-import math, time, logging
+import asyncio, math, time, logging
+from bisect import bisect_right
+from itertools import accumulate
 from typing import Any, Dict, List, Optional, Tuple
 
 from packages.core.settings import get_settings
@@ -12,13 +14,21 @@ from packages.storage.repo import (
 )
 from packages.storage import repo  # needed for compactor mutations
 from packages.storage.models import Message
-from packages.utils.tokens import approx_tokens, profile_text_view
-from packages.utils.i18n import pick_lang, t
+from packages.utils.tokens import estimate_tokens, estimate_tokens_batch, load_bpe_encoder, profile_text_view
+from packages.utils.i18n import STRINGS, pick_lang, t
 from packages.orchestration.token_budget import tokens_breakdown
 from packages.orchestration import summarizer
 
 logger = logging.getLogger("app.context")
 
+# Static system prompt prefix per language (instruction + core header), built once;
+# only the profile and tool results are joined per request.
+_SYS_SKELETON = {
+    lang: '\n'.join([t(lang, 'instruction'), t(lang, 'divider'), t(lang, 'core_profile')])
+    for lang in STRINGS
+}
+_TOOLS_HEADER = {lang: '\n'.join([t(lang, 'divider'), t(lang, 'tool_results')]) for lang in STRINGS}
+
 # --- Helpers ---
 
 def build_pairs_asc(items: List[Message]) -> List[Tuple[Message, Message]]:
@@ -40,6 +50,43 @@ def flatten_pairs_asc(pairs: List[Tuple[Message, Message]]):
         out.append({'role': 'assistant', 'content': sanitize_for_memory(a.content or ''), 'id': a.id})
     return out
 
+# Squeeze weights: under pressure a section keeps a share of the budget proportional to
+# saliency * tokens above its floor (current user turn is never squeezed)
+SQUEEZE_SALIENCY = {'tools': 1.0, 'l3': 2.0, 'l2': 3.0, 'l1': 4.0}
+
+
+def allocate_keep_tokens(sections: List[Tuple[str, float, int, int]], budget: int) -> Dict[str, int]:
+    """Single-pass allocation of `budget` tokens over (id, saliency, tokens, min_tokens).
+
+    Every section keeps its floor; the rest is split by saliency-weighted size and
+    capped at the section's current tokens. No iteration and no re-counting.
+    """
+    if budget >= sum(tok for _, _, tok, _ in sections):
+        return {sid: tok for sid, _, tok, _ in sections}
+    floors = sum(min(tok, lo) for _, _, tok, lo in sections)
+    spare = max(0, budget - floors)
+    weights = [(sid, sal * max(0, tok - lo), tok, min(tok, lo)) for sid, sal, tok, lo in sections]
+    total_w = sum(w for _, w, _, _ in weights)
+    out: Dict[str, int] = {}
+    for sid, w, tok, lo in weights:
+        share = spare * w // total_w if total_w else 0
+        out[sid] = min(tok, lo + int(share))
+    return out
+
+
+def _trim_oldest(msgs: List[Dict[str, Any]], tokens: int, keep: int, step: int = 1) -> List[Dict[str, Any]]:
+    """Drop oldest items (in groups of `step`) until the scaled estimate fits `keep`."""
+    if keep >= tokens or not msgs:
+        return msgs
+    est = estimate_tokens_batch([str(m.get('content', '')) for m in msgs])
+    scale = tokens / max(1, sum(est))
+    used = sum(est)
+    start = 0
+    while start < len(msgs) and used * scale > keep:
+        used -= sum(est[start:start + step])
+        start += step
+    return msgs[start:]
+
 # --- HF-33 Preflight Compactor ---
 async def compact_to_budget(model_id: str,
                             thread_id: str,
@@ -138,22 +185,8 @@ async def compact_to_budget(model_id: str,
             break
     return breakdown, steps, counters
 
-# --- Main assembler ---
-async def assemble_context(
-    thread_id: str,
-    model_id: str,
-    max_output_tokens: Optional[int] = None,
-    tool_results_text: Optional[str] = None,
-    tool_results_tokens: Optional[int] = None,
-    last_user_lang: Optional[str] = None,
-    current_user_text: Optional[str] = None,
-    current_user_id: Optional[str] = None,
-) -> Dict[str, Any]:
-    st = get_settings()
-    prof = get_profile()
-    lang = pick_lang(last_user_lang, prof.preferred_language)
-
-    prof_dict = {
+def _profile_dict(prof) -> Dict[str, Any]:
+    return {
         'display_name': prof.display_name,
         'preferred_language': prof.preferred_language,
         'tone': prof.tone,
@@ -171,35 +204,116 @@ async def assemble_context(
         'runtime': prof.runtime,
         'hardware_hint': prof.hardware_hint,
     }
-    core_text_full = profile_text_view(prof_dict)
-    core_tokens = approx_tokens(core_text_full)
-    core_cap = int(math.ceil(core_tokens * 1.10))
 
+
+def _load_memory(thread_id: str, exclude_message_id: Optional[str], st) -> Tuple[List[Any], List[Any], List[Any]]:
+    """L3, L2 and raw L1 history for a thread (sync reads, run off the event loop)."""
+    l3_records = get_l3_for_thread(thread_id, limit=getattr(st, 'L3_FETCH_LIMIT', 200))
+    l2_records = get_l2_for_thread(thread_id, limit=getattr(st, 'L2_FETCH_LIMIT', 500))
+    hist = get_thread_messages_for_l1(thread_id, exclude_message_id=exclude_message_id, max_items=2000)
+    return l3_records, l2_records, hist
+
+_BUDGET_KEYS = ('C_eff','R_out','R_sys','Safety','B_total_in','B_work','core_sys_pad','core_reserved','effective_max_output_tokens')
+
+
+def _current_user_only_context(model_id: str, skeleton: str, core_text_full: str, core_cap: int, min_core: int,
+                               current_user_text: str, current_user_id: Optional[str], current_user_tokens: int,
+                               budgets: Dict[str, Any]) -> Dict[str, Any]:
+    """Minimal context when the window can't hold more than skeleton + core minimum + the user turn:
+    no tools/L1/L2/L3, no compaction, the current user message is kept whole."""
+    core_text = core_text_full[:min_core * 4]
+    system_text = '\n'.join(b for b in [skeleton, core_text] if b)
+    blocks = {
+        'system': [{'role': 'system', 'content': system_text}],
+        'l3': [], 'l2': [], 'l1': [],
+        'user': [{'role': 'user', 'content': current_user_text, 'id': current_user_id or 'current_user'}],
+    }
+    bd = tokens_breakdown(model_id, blocks)
+    C_eff = int(budgets.get('C_eff', 0))
+    R_sys = int(budgets.get('R_sys', 0))
+    Safety = int(budgets.get('Safety', 0))
+    stats = {
+        'order': ['core','tools','l3','l2','l1'],
+        'tokens': {'core': estimate_tokens(core_text), 'tools': 0, 'l3': 0, 'l2': 0, 'l1': 0, 'total_in': bd.get('total', 0)},
+        'caps': {'core_cap': core_cap, 'tools_cap': 0, 'l1': 0, 'l2': 0, 'l3': 0},
+        'budget': {k: budgets.get(k) for k in _BUDGET_KEYS},
+        'free_out_cap': max(0, C_eff - bd.get('total', 0) - R_sys - Safety),
+        'l1_pairs_count': 0,
+        'compaction_steps': [],
+        'squeezes': [],
+        'prompt_tokens_precise': bd.get('total', 0),
+        'token_count_mode': bd.get('token_count_mode'),
+        'includes': {'l3_ids': [], 'l2_pairs': [], 'l1_pairs': []},
+        'l3_quality': [],
+        'l1_order_preview': [],
+        'fill_pct': {'l1': 0, 'l2': 0, 'l3': 0},
+        'free_pct': {'l1': 100, 'l2': 100, 'l3': 100},
+        'current_user_only_mode': True,
+        'current_user_tokens': current_user_tokens,
+    }
+    return {
+        'system_text': system_text,
+        'messages': [],
+        'provider_messages': blocks['system'] + blocks['user'],
+        'stats': stats,
+        'context_budget': budgets,
+    }
+
+# --- Main assembler ---
+async def assemble_context(
+    thread_id: str,
+    model_id: str,
+    max_output_tokens: Optional[int] = None,
+    tool_results_text: Optional[str] = None,
+    tool_results_tokens: Optional[int] = None,
+    last_user_lang: Optional[str] = None,
+    current_user_text: Optional[str] = None,
+    current_user_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    st = get_settings()
+    await load_bpe_encoder()
+
+    prof = get_profile()
+    core_text_full = profile_text_view(_profile_dict(prof))
+    core_tokens = estimate_tokens(core_text_full)
+    core_cap = int(math.ceil(core_tokens * 1.10))
     budgets = await compute_budgets(model_id, max_output_tokens, core_tokens=core_tokens, core_cap=core_cap, settings=st)
+    lang = pick_lang(last_user_lang, prof.preferred_language)
+    skeleton = _SYS_SKELETON.get(lang) or _SYS_SKELETON['en']
+
+    # Window too small for anything beyond skeleton + core minimum + the user turn
+    current_user_tokens = estimate_tokens(current_user_text) if current_user_text else 0
+    min_core = int(st.context_min_core_skeleton_tok)
+    if current_user_text and int(budgets.get('B_total_in') or 0) < estimate_tokens(skeleton) + min_core + current_user_tokens:
+        return _current_user_only_context(model_id, skeleton, core_text_full, core_cap, min_core,
+                                          current_user_text, current_user_id, current_user_tokens, budgets)
+
+    # memory is read only once the mode is known: current-user-only mode touches no L1/L2/L3
+    l3_records, l2_records, hist = await asyncio.to_thread(_load_memory, thread_id, current_user_id, st)
+
     B_work = int(budgets.get('B_work', 0))
     tools_cap = int(min(st.mem_tools_max_share * B_work, B_work))
     if tool_results_text and tool_results_tokens is None:
-        tool_results_tokens = approx_tokens(tool_results_text)
+        tool_results_tokens = estimate_tokens(tool_results_text)
     tools_src_txt = tool_results_text or ''
-    tools_used = min(int(tool_results_tokens or approx_tokens(tools_src_txt)), tools_cap)
+    tools_src_tokens = int(tool_results_tokens or estimate_tokens(tools_src_txt))
+    tools_used = min(tools_src_tokens, tools_cap)
     work_left = max(0, B_work - tools_used)
     L1_cap = int(st.mem_l1_share * work_left)
     L2_cap = int(st.mem_l2_share * work_left)
     L3_cap = int(st.mem_l3_share * work_left)
 
-    l3_records = get_l3_for_thread(thread_id, limit=getattr(st, 'L3_FETCH_LIMIT', 200))
-    l2_records = get_l2_for_thread(thread_id, limit=getattr(st, 'L2_FETCH_LIMIT', 500))
-
-    hist = get_thread_messages_for_l1(thread_id, exclude_message_id=current_user_id, max_items=2000)
     pairs_all = build_pairs_asc(hist)
 
-    D = t(lang, 'divider')
+    tools_header = _TOOLS_HEADER.get(lang) or _TOOLS_HEADER['en']
     def build_system(core_text: str, tools_text: str) -> str:
-        blocks = [t(lang, 'instruction'), D, t(lang, 'core_profile'), core_text]
+        blocks = [skeleton, core_text]
         if tools_text:
-            blocks += [D, t(lang, 'tool_results'), tools_text]
+            blocks += [tools_header, tools_text]
         return '\n'.join(b for b in blocks if b)
-    tools_text = sanitize_for_memory(tools_src_txt[:tools_cap*4]) if tools_used > 0 and tools_src_txt else ''
+    # cut by the measured chars/token ratio instead of re-tokenizing the tail
+    tools_chars = len(tools_src_txt) * tools_used // tools_src_tokens if tools_src_tokens else 0
+    tools_text = sanitize_for_memory(tools_src_txt[:tools_chars]) if tools_used > 0 and tools_src_txt else ''
     system_text = build_system(core_text_full, tools_text)
 
     msgs_system = [{'role': 'system', 'content': system_text}] if system_text else []
@@ -209,22 +323,46 @@ async def assemble_context(
 
     # Fill L1 newest->oldest within cap & free out constraint approximation
     C_eff = int(budgets.get('C_eff', 0)); R_sys = int(budgets.get('R_sys', 0)); Safety = int(budgets.get('Safety', 0))
-    chosen_pairs: List[Tuple[Message, Message]] = []
-    for (u, a) in reversed(pairs_all):
-        trial = [(u, a)] + chosen_pairs
-        trial_l1 = flatten_pairs_asc(trial)
-        bd_try = tokens_breakdown(model_id, {'system': msgs_system, 'l3': msgs_l3, 'l2': msgs_l2, 'l1': trial_l1, 'user': ([{'role':'user','content': current_user_text or ''}] if current_user_text else [])})
-        if bd_try['l1'] <= L1_cap and (C_eff - bd_try['total'] - R_sys - Safety) >= 0:
-            chosen_pairs = trial
+    msgs_user = [{'role': 'user', 'content': current_user_text or ''}] if current_user_text else []
+    flat_all = flatten_pairs_asc(pairs_all)  # sanitized once, 2 messages per pair
+    n_pairs = len(pairs_all)
+
+    def l1_tail(k: int) -> List[Dict[str, Any]]:
+        return flat_all[2 * (n_pairs - k):] if k else []
+
+    def fits(k: int) -> bool:
+        bd_try = tokens_breakdown(model_id, {'system': msgs_system, 'l3': msgs_l3, 'l2': msgs_l2, 'l1': l1_tail(k), 'user': msgs_user})
+        return bd_try['l1'] <= L1_cap and (C_eff - bd_try['total'] - R_sys - Safety) >= 0
+
+    # estimate: newest-first cumulative pair tokens, cut found by bisect against the room
+    # left next to the fixed blocks; then the real counter moves it to the greedy cut (the
+    # largest k that fits): binary search down if it overshot, gallop up if it undershot
+    est = estimate_tokens_batch([m['content'] for m in flat_all])
+    cums = list(accumulate(est[i] + est[i + 1] for i in range(len(est) - 2, -1, -2)))
+    k = 0
+    if n_pairs:
+        bd_base = tokens_breakdown(model_id, {'system': msgs_system, 'l3': msgs_l3, 'l2': msgs_l2, 'l1': [], 'user': msgs_user})
+        room = min(L1_cap, C_eff - bd_base['total'] - R_sys - Safety)
+        k = bisect_right(cums, room) if room > 0 else 0
+        if k and not fits(k):
+            lo, hi = 0, k - 1
         else:
-            break
+            step = 1
+            while k + step <= n_pairs and fits(k + step):
+                k += step
+                step *= 2
+            lo, hi = k, min(n_pairs, k + step - 1)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if fits(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        k = lo
     # Minimum guarantee
-    need_min = max(0, st.L1_MIN_PAIRS - len(chosen_pairs))
-    for _ in range(need_min):
-        idx = len(pairs_all) - len(chosen_pairs) - 1
-        if idx < 0: break
-        chosen_pairs = [pairs_all[idx]] + chosen_pairs
-    l1_msgs_out = flatten_pairs_asc(chosen_pairs)
+    k = min(n_pairs, max(k, st.L1_MIN_PAIRS))
+    chosen_pairs: List[Tuple[Message, Message]] = pairs_all[n_pairs - k:]
+    l1_msgs_out = l1_tail(k)
 
     # Eager grouped L2 for old pairs
     summary_counters: Dict[str, int] = {}
@@ -259,27 +397,59 @@ async def assemble_context(
     caps_levels = {'l1': L1_cap, 'l2': L2_cap, 'l3': L3_cap}
     meta_stub = {'context_budget': {'C_eff': C_eff, 'R_sys': R_sys, 'Safety': Safety}}
     bd_final, comp_steps, counters_added = await compact_to_budget(model_id, thread_id, last_user_lang or 'ru', caps_levels, blocks, meta_stub)
+    # Hard squeeze: if still above B_total_in, trim tools/L3/L2/L1 in one allocation pass
+    squeezes: List[Dict[str, Any]] = []
+    B_total_in = budgets.get('B_total_in')
+    over = int(bd_final.get('total', 0)) - int(B_total_in) if B_total_in is not None else 0
+    if over > 0:
+        sizes = {
+            'tools': estimate_tokens(tools_text) if tools_text else 0,
+            'l3': int(bd_final.get('l3', 0)), 'l2': int(bd_final.get('l2', 0)), 'l1': int(bd_final.get('l1', 0)),
+        }
+        l1_min_msgs = 2 * st.L1_MIN_PAIRS
+        l1_floor = 0
+        if blocks['l1'] and sizes['l1']:
+            est = estimate_tokens_batch([str(m.get('content', '')) for m in blocks['l1']])
+            l1_floor = sizes['l1'] * sum(est[-l1_min_msgs:]) // max(1, sum(est)) if l1_min_msgs else 0
+        sections = [(k, SQUEEZE_SALIENCY[k], v, l1_floor if k == 'l1' else 0) for k, v in sizes.items() if v > 0]
+        keep = allocate_keep_tokens(sections, sum(v for _, _, v, _ in sections) - over)
+        for k, v in keep.items():
+            if v >= sizes[k]:
+                continue
+            squeezes.append({'section': k, 'from': sizes[k], 'to': v})
+            if k == 'tools':
+                tools_text = tools_text[:len(tools_text) * v // sizes[k]] if v > 0 else ''
+                system_text = build_system(core_text_full, tools_text)
+                blocks['system'] = [{'role': 'system', 'content': system_text}] if system_text else []
+                msgs_tools = [{'role': 'system', 'content': tools_text}] if tools_text else []
+            else:
+                blocks[k] = _trim_oldest(blocks[k], sizes[k], v, step=2 if k == 'l1' else 1)
+        if squeezes:
+            bd_final = tokens_breakdown(model_id, blocks)
     # Free out cap after compaction
     free_out_cap = max(0, C_eff - bd_final['total'] - R_sys - Safety)
 
     # Compose provider messages after compaction
     provider_messages = blocks['system'] + msgs_tools + blocks['l3'] + blocks['l2'] + blocks['l1'] + blocks['user']
+    # L1 as sent (after compaction/squeeze), as "u->a" id pairs
+    l1_sent = [f"{blocks['l1'][i]['id']}->{blocks['l1'][i + 1]['id']}" for i in range(0, len(blocks['l1']) - 1, 2)]
 
     stats = {
         'order': ['core','tools','l3','l2','l1'],
         'tokens': {
-            'core': approx_tokens(core_text_full),
-            'tools': approx_tokens(tools_text) if tools_text else 0,
+            'core': core_tokens,
+            'tools': estimate_tokens(tools_text) if tools_text else 0,
             'l3': bd_final.get('l3', 0),
             'l2': bd_final.get('l2', 0),
             'l1': bd_final.get('l1', 0),
             'total_in': bd_final.get('total', 0),
         },
         'caps': {'core_cap': core_cap, 'tools_cap': tools_cap, 'l1': L1_cap, 'l2': L2_cap, 'l3': L3_cap},
-        'budget': {k: budgets.get(k) for k in ('C_eff','R_out','R_sys','Safety','B_total_in','B_work','core_sys_pad','core_reserved','effective_max_output_tokens')},
+        'budget': {k: budgets.get(k) for k in _BUDGET_KEYS},
         'free_out_cap': free_out_cap,
-        'l1_pairs_count': len(chosen_pairs),
+        'l1_pairs_count': len(l1_sent),
         'compaction_steps': comp_steps,
+        'squeezes': squeezes,
         'prompt_tokens_precise': bd_final.get('total', 0),
         'token_count_mode': bd_final.get('token_count_mode'),
         'includes': {
@@ -289,10 +459,9 @@ async def assemble_context(
         },
         # HF-34.2: L3 quality (length in characters) for UI indicator
         'l3_quality': [{'id': r.id, 'chars': len((r.text or '').strip())} for r in l3_records],
-        'l1_order_preview': (
-            ([f"{p[0].id}->{p[1].id}" for p in chosen_pairs[:3]] + ['...'] + [f"{p[0].id}->{p[1].id}" for p in chosen_pairs[-3:]])
-            if len(chosen_pairs) > 6 else [f"{p[0].id}->{p[1].id}" for p in chosen_pairs]
-        ),
+        'l1_order_preview': l1_sent[:3] + ['...'] + l1_sent[-3:] if len(l1_sent) > 6 else l1_sent,
+        'current_user_only_mode': False,
+        'current_user_tokens': current_user_tokens,
     }
     if summary_counters:
         sc_all = summary_counters.copy()
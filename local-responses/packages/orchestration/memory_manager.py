@@ -1,22 +1,22 @@
 from __future__ import annotations
 
 import math
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from packages.core.settings import get_settings
+from packages.core.settings import get_settings, get_settings_frozen
 from packages.storage.repo import (
     get_or_create_memory_state,
     get_messages_since,
     insert_l2,
     insert_l3,
     trim_l3_if_over,
-    update_memory_counters,
+    update_memory_counters_async,
 )
-from packages.utils.tokens import approx_tokens
+from packages.utils.tokens import approx_tokens, approx_tokens_batch
 
 
 def compute_level_caps(B_work: int, tools_tokens: int = 0) -> Dict[str, int]:
-    st = get_settings()
+    st = get_settings_frozen()
     if B_work <= 0:
         return {"l1": 0, "l2": 0, "l3": 0}
     tools_share = 0.0
@@ -30,27 +30,24 @@ def compute_level_caps(B_work: int, tools_tokens: int = 0) -> Dict[str, int]:
 
 def build_l1_pairs(messages: List[Any]) -> Tuple[List[Tuple[str, str]], int]:
     st = get_settings()
+    # approx_tokens(x) > cap  <=>  len(x) > cap*4, so a plain slice is the cap
+    # (slicing a shorter str returns it unchanged, no copy)
+    max_u = st.cap_tok_user * 4
+    max_a = st.cap_tok_assistant * 4
     pairs: List[Tuple[str, str]] = []
+    add = pairs.append
     # walk from end, build user->assistant pairs
     i = len(messages) - 1
-    last_user_lang = None
-    while i >= 0:
-        if messages[i].role == 'assistant' and i - 1 >= 0 and messages[i-1].role == 'user':
-            user_txt = messages[i-1].content or ''
-            asst_txt = messages[i].content or ''
-            # cap contributions by tokens
-            if approx_tokens(user_txt) > st.cap_tok_user:
-                # rough cap by characters
-                max_chars = st.cap_tok_user * 4
-                user_txt = user_txt[:max_chars]
-            if approx_tokens(asst_txt) > st.cap_tok_assistant:
-                max_chars = st.cap_tok_assistant * 4
-                asst_txt = asst_txt[:max_chars]
-            pairs.insert(0, (user_txt, asst_txt))
+    while i > 0:
+        m = messages[i]
+        prev = messages[i-1]
+        if m.role == 'assistant' and prev.role == 'user':
+            add(((prev.content or '')[:max_u], (m.content or '')[:max_a]))
             i -= 2
         else:
             i -= 1
-    total_tokens = sum(approx_tokens(u) + approx_tokens(a) for (u, a) in pairs)
+    pairs.reverse()
+    total_tokens = sum(approx_tokens_batch([t for pair in pairs for t in pair]))
     return pairs, total_tokens
 
 
@@ -67,18 +64,18 @@ def _summarize_pairs_to_bullets(pairs: List[Tuple[str, str]], max_lines_per_pair
     return text
 
 
-def promote_l1_to_l2(thread_id: str, pairs: List[Tuple[str, str]], batch_size: int) -> Tuple[int, int, str, str]:
+def promote_l1_to_l2(thread_id: str, pairs: List[Tuple[str, str]], batch_size: int, now: Optional[int] = None) -> Tuple[int, int, str, str]:
     if not pairs:
         return 0, 0, None, None  # type: ignore[return-value]
     take = pairs[:batch_size]
     text = _summarize_pairs_to_bullets(take, max_lines_per_pair=2)
     toks = approx_tokens(text)
     # start and end message ids are not known here (we passed sanitized messages only); store placeholders
-    l2 = insert_l2(thread_id, start_msg_id="auto", end_msg_id="auto", text=text, tokens=toks)
+    l2 = insert_l2(thread_id, start_msg_id="auto", end_msg_id="auto", text=text, tokens=toks, now=now)
     return len(take), toks, l2.start_message_id, l2.end_message_id
 
 
-def promote_l2_to_l3(thread_id: str, l2_items: List[Any], batch_size: int) -> Tuple[int, int, int, int]:
+def promote_l2_to_l3(thread_id: str, l2_items: List[Any], batch_size: int, now: Optional[int] = None) -> Tuple[int, int, int, int]:
     if not l2_items:
         return 0, 0, 0, 0
     take = l2_items[:batch_size]
@@ -88,7 +85,7 @@ def promote_l2_to_l3(thread_id: str, l2_items: List[Any], batch_size: int) -> Tu
     toks = approx_tokens(text)
     start_id = take[0].id
     end_id = take[-1].id
-    insert_l3(thread_id, start_l2_id=start_id, end_l2_id=end_id, text=text, tokens=toks)
+    insert_l3(thread_id, start_l2_id=start_id, end_l2_id=end_id, text=text, tokens=toks, now=now)
     return len(take), toks, start_id, end_id
 
 
@@ -111,7 +108,7 @@ async def update_memory(thread_id: str, budget: Dict[str, Any], tool_results_tok
     l1_free = free_pct(l1_tokens, caps['l1'])
     # promote L1->L2 if low free
     if caps['l1'] > 0 and l1_free < st.mem_free_threshold and pairs:
-        moved, toks, s_id, e_id = promote_l1_to_l2(thread_id, pairs, st.mem_promotion_batch_size)
+        moved, toks, s_id, e_id = promote_l1_to_l2(thread_id, pairs, st.mem_promotion_batch_size, now=now)
         actions.append(f"promoted_l1_to_l2:{moved}")
         # after promotion, reset l1_tokens for simplicity (in real impl we'd drop oldest pairs)
         pairs = pairs[moved:]
@@ -126,7 +123,7 @@ async def update_memory(thread_id: str, budget: Dict[str, Any], tool_results_tok
 
     # promote L2->L3 if low free
     if caps['l2'] > 0 and l2_free < st.mem_free_threshold and l2_items:
-        moved2, toks2, start_id, end_id = promote_l2_to_l3(thread_id, l2_items, st.mem_promotion_batch_size)
+        moved2, toks2, start_id, end_id = promote_l2_to_l3(thread_id, l2_items, st.mem_promotion_batch_size, now=now)
         actions.append(f"promoted_l2_to_l3:{moved2}")
         # recompute l2_tokens after promotion (we keep L2; could prune separately)
         with session_scope() as s:
@@ -146,7 +143,7 @@ async def update_memory(thread_id: str, budget: Dict[str, Any], tool_results_tok
             l3_items = list(s.query(_L3).filter(_L3.thread_id == thread_id).order_by(_L3.id.asc()))
             l3_tokens = sum(x.tokens or 0 for x in l3_items)
 
-    update_memory_counters(thread_id, l1_tokens=l1_tokens, l2_tokens=l2_tokens, l3_tokens=l3_tokens)
+    await update_memory_counters_async(thread_id, l1_tokens=l1_tokens, l2_tokens=l2_tokens, l3_tokens=l3_tokens, now=now)
 
     free = {
         'l1': free_pct(l1_tokens, caps['l1']),
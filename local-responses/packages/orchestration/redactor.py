@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import re
+from functools import lru_cache
 from typing import Any, Dict
 
 
@@ -18,8 +19,22 @@ def redact_fragment(text: str) -> str:
     """
     if not text:
         return text
-    cleaned = _THINK_RX.sub("", text)
-    return cleaned
+    if "</" not in text:
+        # every match ends with a closing tag; a substring scan is far cheaper than the regex
+        return text
+    if len(text) > _REDACT_CACHE_MAX_CHARS:
+        return _THINK_RX.sub("", text)
+    return _redact_cached(text)
+
+
+# The cache holds key and result text: only short fragments, so it stays a few MB at most
+_REDACT_CACHE_MAX_CHARS = 4096
+
+
+@lru_cache(maxsize=1024)
+def _redact_cached(text: str) -> str:
+    # History rows are re-sanitized on every turn; unchanged content hits the cache.
+    return _THINK_RX.sub("", text)
 
 
 def sanitize_for_memory(text: str) -> str:
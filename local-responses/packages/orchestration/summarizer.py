@@ -4,6 +4,7 @@ from __future__ import annotations
 import hashlib
 import html
 import re
+import time
 from datetime import datetime, UTC
 from typing import Dict, List, Optional, Tuple, Sequence
 
@@ -190,7 +191,7 @@ async def try_autosummarize(thread_id: str, messages: List[Dict[str, str]]) -> N
         th = s.get(Thread, thread_id)
         if not th:
             return
-    now_ts = int(datetime.now(UTC).timestamp())
+    now_ts = int(time.time())
 
     source_messages: List[Dict[str, str]] = [
         m for m in messages if m.get("role") in ("user", "assistant", "tool")
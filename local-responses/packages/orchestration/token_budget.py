@@ -3,7 +3,7 @@ from typing import List, Dict, Any, Tuple
 
 from packages.core.settings import get_settings
 from packages.providers import lmstudio_tokens
-from packages.utils.tokens import approx_tokens_messages
+from packages.utils.tokens import estimate_tokens_messages
 
 
 def tokens_breakdown(model_id: str, messages_blocks: Dict[str, List[Dict[str, Any]]]) -> Dict[str, int | str]:
@@ -15,8 +15,8 @@ def tokens_breakdown(model_id: str, messages_blocks: Dict[str, List[Dict[str, An
                 n, mode = lmstudio_tokens.count_tokens_chat(model_id, msgs)
                 return int(n), mode
             except Exception:
-                return approx_tokens_messages(msgs), 'approx'
-        return approx_tokens_messages(msgs), 'approx'
+                return estimate_tokens_messages(msgs), 'approx'
+        return estimate_tokens_messages(msgs), 'approx'
 
     sys_msgs = messages_blocks.get('system', [])
     l3_full = sys_msgs + messages_blocks.get('l3', [])
@@ -2,13 +2,13 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import math
 from typing import Any, AsyncIterator, Dict, Optional, List
 
 import httpx
 
-from packages.core.settings import get_settings
+from packages.core.settings import AppSettings, get_settings
+from packages.utils.tokens import json_loads
 
 # Compatibility shim for tests/imports expecting package-like structure
 # Expose submodules as attributes on this module
@@ -169,8 +169,8 @@ class LMStudioProvider:
                         if data_str.strip() == "[DONE]":
                             break
                         try:
-                            obj = json.loads(data_str)
-                        except json.JSONDecodeError:
+                            obj = json_loads(data_str)
+                        except ValueError:
                             continue
                         choices = obj.get("choices") or []
                         if not choices:
@@ -221,8 +221,8 @@ class LMStudioProvider:
             raise
 
 
-def get_lmstudio_provider() -> LMStudioProvider:
-    settings = get_settings()
+def get_lmstudio_provider(settings: Optional[AppSettings] = None) -> LMStudioProvider:
+    settings = settings or get_settings()
     if not settings.lmstudio_base_url:
         raise RuntimeError("LMSTUDIO_BASE_URL is not configured")
     return LMStudioProvider(base_url=str(settings.lmstudio_base_url))
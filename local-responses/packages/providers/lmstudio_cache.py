@@ -23,3 +23,7 @@ def get_cached(key: str) -> Optional[Dict[str, Any]]:
 
 def set_cached(key: str, value: Dict[str, Any], ttl_sec: int) -> None:
     _cache[key] = {"val": value, "exp": time.time() + max(1, int(ttl_sec))}
+
+def clear_cache() -> None:
+    _cache.clear()
+    _locks.clear()
@@ -4,7 +4,7 @@ import logging
 import httpx
 from typing import List, Dict, Tuple
 
-from packages.utils.tokens import approx_tokens, approx_tokens_messages
+from packages.utils.tokens import approx_tokens, estimate_tokens_messages
 
 LMSTUDIO_BASE_URL = os.getenv("LMSTUDIO_BASE_URL", "http://192.168.0.111:1234").rstrip("/")
 log = logging.getLogger(__name__)
@@ -49,7 +49,7 @@ def count_tokens_chat(model_id: str, messages: List[Dict], timeout: float = 3.0,
         return n, "proxy-http"
     except Exception as e:  # noqa: BLE001
         log.warning("LMStudio HTTP tokenization failed (approx): %s", e)
-        n = approx_tokens_messages(messages)
+        n = estimate_tokens_messages(messages)
         _cache[k] = {"n": n, "t": now, "mode": "approx"}
         return n, "approx"
 
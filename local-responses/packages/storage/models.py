@@ -1,6 +1,7 @@
 # packages/storage/models.py
 from __future__ import annotations
 
+import time
 from datetime import datetime
 from decimal import Decimal
 
@@ -10,6 +11,7 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
     String,
@@ -56,11 +58,15 @@ class Message(Base):
     input_tokens = Column(Integer, nullable=True)
     output_tokens = Column(Integer, nullable=True)
     total_tokens = Column(Integer, nullable=True)
+    # approx_tokens of the <think>-redacted content, filled at insert (NULL on legacy rows)
+    sanitized_tokens = Column(Integer, nullable=True)
 
     thread = relationship("Thread", back_populates="messages")
 
     __table_args__ = (
         CheckConstraint("role in ('system','user','assistant','tool')", name="ck_messages_role"),
+        # per-thread range scans ordered by time (context window, since-last, L1 history)
+        Index("ix_messages_thread_order", "thread_id", "created_at", "id"),
     )
 
 
@@ -110,7 +116,9 @@ class Profile(Base):
     hardware_hint = Column(String(128), nullable=True)
 
     # Metadata
-    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
+    # Python-side default/onupdate mirror the server default so the flushed row carries its
+    # timestamp in memory and callers never need a refresh roundtrip
+    updated_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=datetime.utcnow, nullable=False)
     source = Column(String(64), nullable=True)
     confidence = Column(Integer, nullable=True)
 
@@ -124,7 +132,7 @@ class MemoryState(Base):
     l1_tokens = Column(Integer, default=0)
     l2_tokens = Column(Integer, default=0)
     l3_tokens = Column(Integer, default=0)
-    updated_at = Column(Integer, nullable=False, default=lambda: int(datetime.utcnow().timestamp()))
+    updated_at = Column(Integer, nullable=False, default=lambda: int(time.time()))
 
 
 class L2Summary(Base):
@@ -136,7 +144,7 @@ class L2Summary(Base):
     end_message_id = Column(String(64), nullable=False)
     text = Column(Text, nullable=False)
     tokens = Column(Integer, nullable=False)
-    created_at = Column(Integer, nullable=False, default=lambda: int(datetime.utcnow().timestamp()))
+    created_at = Column(Integer, nullable=False, default=lambda: int(time.time()))
 
 
 class L3MicroSummary(Base):
@@ -148,7 +156,7 @@ class L3MicroSummary(Base):
     end_l2_id = Column(Integer, nullable=False)
     text = Column(Text, nullable=False)
     tokens = Column(Integer, nullable=False)
-    created_at = Column(Integer, nullable=False, default=lambda: int(datetime.utcnow().timestamp()))
+    created_at = Column(Integer, nullable=False, default=lambda: int(time.time()))
 
 
 class ToolRun(Base):
@@ -2,29 +2,126 @@
 from __future__ import annotations
 
 import json
+import threading
+import time
 import uuid
+import weakref
+from collections import defaultdict
 from contextlib import contextmanager
-from datetime import datetime, UTC
+from contextvars import ContextVar
+from datetime import datetime, timedelta, UTC
 from decimal import Decimal
-from typing import Any, Dict, Optional, List, Tuple
+from typing import Any, Dict, NamedTuple, Optional, List, Tuple
 import asyncio
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, delete, event, func, insert, literal, or_, select, tuple_
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
 
 from packages.core.settings import get_settings
 from packages.storage.models import Base, Message, Response, Thread, Profile, MemoryState, L2Summary, L3MicroSummary, ToolRun
-from packages.utils.tokens import approx_tokens
+from packages.utils.tokens import approx_tokens, approx_tokens_batch
 from packages.orchestration.redactor import redact_fragment, sanitize_for_memory
 
 
+def _engine_kwargs(st) -> Dict[str, Any]:
+    if st.db_dialect.startswith("sqlite"):
+        # writes are handed to worker threads (asyncio.to_thread), so connections cross threads
+        kw: Dict[str, Any] = {"connect_args": {"check_same_thread": False}}
+        if st.db_url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in st.db_url:
+            kw["poolclass"] = StaticPool  # one shared connection, otherwise each checkout sees an empty DB
+        return kw
+    return {
+        "pool_size": st.db_pool_size,
+        "max_overflow": st.db_max_overflow,
+        "pool_timeout": st.db_pool_timeout,
+        "pool_recycle": st.db_pool_recycle,
+        "pool_pre_ping": st.db_pool_pre_ping,
+    }
+
+
+# WAL + NORMAL: one fsync per checkpoint instead of two per commit; readers never block the writer
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def _sqlite_on_connect(dbapi_conn, _record) -> None:
+    cur = dbapi_conn.cursor()
+    try:
+        for pragma in _SQLITE_PRAGMAS:
+            cur.execute(pragma)
+    finally:
+        cur.close()
+
+
 settings = get_settings()
-engine = create_engine(settings.db_url, echo=False, future=True)
+engine = create_engine(settings.db_url, echo=False, future=True, **_engine_kwargs(settings))
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _sqlite_on_connect)
 Base.metadata.create_all(engine)
 
 
+# Statements built once at import; the engine's compiled cache then reuses their SQL
+# instead of constructing a fresh INSERT per helper call.
+_INSERT_L2 = insert(L2Summary).returning(L2Summary)
+_INSERT_L2_IDS = insert(L2Summary).returning(L2Summary.id)
+_INSERT_L3 = insert(L3MicroSummary).returning(L3MicroSummary)
+_INSERT_L2_MANY = insert(L2Summary).returning(L2Summary, sort_by_parameter_order=True)
+_INSERT_L3_MANY = insert(L3MicroSummary).returning(L3MicroSummary, sort_by_parameter_order=True)
+_INSERT_TOOL_RUN = insert(ToolRun).returning(ToolRun)
+
+
+class _RequestSession:
+    __slots__ = ("session", "thread", "open")
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        self.thread = threading.get_ident()
+        self.open = True
+
+
+_request_session: ContextVar[Optional[_RequestSession]] = ContextVar("request_session", default=None)
+
+
+@contextmanager
+def request_session_scope():
+    """One session/transaction shared by every session_scope() of the current request.
+    Joined scopes only flush; this scope commits (or rolls back) once at the end. Only code
+    on the opening thread joins: worker threads and the writer queue keep their own sessions.
+    """
+    with Session(engine, future=True, expire_on_commit=False) as session:
+        holder = _RequestSession(session)
+        token = _request_session.set(holder)
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            # tasks spawned during the request inherit the var; a closed holder is ignored
+            holder.open = False
+            _request_session.reset(token)
+
+
 @contextmanager
 def session_scope() -> Session:
+    holder = _request_session.get()
+    if holder is not None and holder.open and holder.thread == threading.get_ident():
+        session = holder.session
+        try:
+            yield session
+            session.flush()
+        except Exception:
+            session.rollback()
+            raise
+        return
     with Session(engine, future=True, expire_on_commit=False) as session:
         try:
             yield session
@@ -52,8 +149,7 @@ def set_thread_summarizing(thread_id: str, flag: bool) -> None:
         th = s.get(Thread, thread_id)
         if th:
             th.is_summarizing = flag
-            th.last_summary_run_at = int(datetime.now(UTC).timestamp()) if flag else th.last_summary_run_at
-            s.add(th)
+            th.last_summary_run_at = int(time.time()) if flag else th.last_summary_run_at
 
 
 def save_thread_summary(
@@ -69,42 +165,86 @@ def save_thread_summary(
         th.summary_quality = quality
         th.summary_source_hash = source_hash
         th.is_summarizing = False
-        s.add(th)
 
 
-def append_message(
+def _message_row(
     thread_id: str,
     role: str,
     content: str,
     tokens: Optional[Dict[str, int]] = None,
     finish_reason: Optional[str] = None,
     attempt: Optional[int] = None,
-) -> Message:
+) -> Optional[Dict[str, Any]]:
     # Не сохранять первую попытку assistant-ответа при finish_reason:'length' (ретрай)
     if role == "assistant" and finish_reason == "length" and (attempt is None or attempt == 1):
         return None
-    mid = uuid.uuid4().hex
-    msg = Message(
-        id=mid,
-        thread_id=thread_id,
-        role=role,
-        content=content,
-    )
+    row: Dict[str, Any] = {
+        "id": uuid.uuid4().hex, "thread_id": thread_id, "role": role, "content": content,
+        "sanitized_tokens": approx_tokens(redact_fragment(content or "")),
+    }
     if tokens:
-        msg.input_tokens = tokens.get("input_tokens")
-        msg.output_tokens = tokens.get("output_tokens")
+        row["input_tokens"] = tokens.get("input_tokens")
+        row["output_tokens"] = tokens.get("output_tokens")
         total = tokens.get("total_tokens")
         if total is None:
-            total = (msg.input_tokens or 0) + (msg.output_tokens or 0)
-        msg.total_tokens = total
+            total = (row["input_tokens"] or 0) + (row["output_tokens"] or 0)
+        row["total_tokens"] = total
     else:
-        msg.total_tokens = approx_tokens(content)
+        row["total_tokens"] = approx_tokens(content)
+    return row
+
+
+def _build_message(
+    thread_id: str,
+    role: str,
+    content: str,
+    tokens: Optional[Dict[str, int]] = None,
+    finish_reason: Optional[str] = None,
+    attempt: Optional[int] = None,
+) -> Optional[Message]:
+    row = _message_row(thread_id, role, content, tokens, finish_reason, attempt)
+    return Message(**row) if row is not None else None
+
+
+def append_message(
+    thread_id: str,
+    role: str,
+    content: str,
+    tokens: Optional[Dict[str, int]] = None,
+    finish_reason: Optional[str] = None,
+    attempt: Optional[int] = None,
+) -> Message:
+    msg = _build_message(thread_id, role, content, tokens, finish_reason, attempt)
+    if msg is None:
+        return None
     with session_scope() as s:
         s.add(msg)
     return msg
 
 
-def save_response(
+def append_messages_bulk(thread_id: str, items: List[Dict[str, Any]]) -> List[str]:
+    """Insert many messages in one transaction (single executemany INSERT).
+    items: dicts with role/content and optional tokens/finish_reason/attempt, in thread order.
+    Returns ids of the stored rows; skipped items (first 'length' attempt) are not included."""
+    rows = [
+        r for r in (
+            _message_row(thread_id, it["role"], it["content"], it.get("tokens"), it.get("finish_reason"), it.get("attempt"))
+            for it in items
+        )
+        if r is not None
+    ]
+    if not rows:
+        return []
+    # explicit, strictly increasing created_at keeps the batch in order (ids are random uuids)
+    base = datetime.utcnow()
+    for i, r in enumerate(rows):
+        r["created_at"] = base + timedelta(microseconds=i)
+    with session_scope() as s:
+        s.execute(insert(Message), rows)
+    return [r["id"] for r in rows]
+
+
+def _build_response(
     *,
     resp_id: str,
     thread_id: str,
@@ -117,7 +257,7 @@ def save_response(
     usage: Dict[str, int],
     cost: Decimal,
 ) -> Response:
-    record = Response(
+    return Response(
         id=resp_id,
         thread_id=thread_id,
         request_json=request_json,
@@ -131,6 +271,26 @@ def save_response(
         total_tokens=usage.get("total_tokens", 0),
         cost=cost,
     )
+
+
+def save_response(
+    *,
+    resp_id: str,
+    thread_id: str,
+    request_json: str,
+    response_json: str,
+    status: str,
+    model: str,
+    provider_name: str,
+    provider_base_url: Optional[str],
+    usage: Dict[str, int],
+    cost: Decimal,
+) -> Response:
+    record = _build_response(
+        resp_id=resp_id, thread_id=thread_id, request_json=request_json, response_json=response_json,
+        status=status, model=model, provider_name=provider_name, provider_base_url=provider_base_url,
+        usage=usage, cost=cost,
+    )
     with session_scope() as s:
         s.add(record)
     return record
@@ -147,28 +307,38 @@ def update_thread_summary(thread_id: str, summary_text: str) -> None:
     )
 
 
+FETCH_CONTEXT_MAX_ROWS = 512
+
+
 def fetch_context(thread_id: str, budget_tokens: int) -> Dict[str, Any]:
-    # System summary + latest messages (user/assistant) up to budget
+    """System summary + latest messages (user/assistant/tool) up to budget.
+    Rows are read newest-first with a LIMIT, so long threads never load their full history;
+    the newest message is kept even when it alone is over budget."""
     with session_scope() as s:
         th = s.get(Thread, thread_id)
         system = th.summary if th and th.summary else "You are a helpful assistant."
-        q = (
-            s.query(Message)
-            .filter(Message.thread_id == thread_id)
-            .order_by(Message.created_at.asc())
+        result = s.execute(
+            select(Message.role, Message.content, Message.sanitized_tokens)
+            .where(Message.thread_id == thread_id, Message.role.in_(("user", "assistant", "tool")))
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .limit(FETCH_CONTEXT_MAX_ROWS)
+            .execution_options(yield_per=64)
         )
-        items = [m for m in q if m.role in ("user", "assistant", "tool")]
-        total = approx_tokens(system)
+        # one pass newest -> oldest straight off the cursor: sanitize, measure, stop at budget
         kept: list[Dict[str, str]] = []
-        for m in reversed(items):
+        total = approx_tokens(system)
+        for role, content, cached_tokens in result:
             # sanitize content for model context (strip <think>)
-            sanitized = redact_fragment(m.content or "")
-            t = approx_tokens(sanitized)
+            txt = redact_fragment(content or "")
+            # token count cached at insert; legacy rows (NULL) are measured here
+            t = cached_tokens if cached_tokens is not None else approx_tokens(txt)
             if total + t > budget_tokens and kept:
                 break
             total += t
-            kept.insert(0, {"role": m.role, "content": sanitized})
-        return {"system": system, "messages": kept}
+            kept.append({"role": role, "content": txt})
+        result.close()
+    kept.reverse()
+    return {"system": system, "messages": kept}
 
 # Profile CRUD
 
@@ -178,11 +348,6 @@ def get_profile() -> Profile:
         if row is None:
             row = Profile(id=1)
             s.add(row)
-            s.flush()
-            try:
-                s.refresh(row)
-            except Exception:
-                pass
         return row
 
 
@@ -201,13 +366,6 @@ def save_profile(data: Dict[str, Any]) -> Profile:
         for k, v in data.items():
             if k in fields:
                 setattr(row, k, v)
-        s.add(row)
-        # Ensure server-generated timestamps are loaded before returning detached instance
-        s.flush()
-        try:
-            s.refresh(row)
-        except Exception:
-            pass
         return row
 
 # Memory CRUD utilities
@@ -216,76 +374,86 @@ def get_or_create_memory_state(thread_id: str) -> MemoryState:
     with session_scope() as s:
         st_row = s.get(MemoryState, thread_id)
         if st_row is None:
-            st_row = MemoryState(thread_id=thread_id, l1_tokens=0, l2_tokens=0, l3_tokens=0, updated_at=int(datetime.now(UTC).timestamp()))
+            st_row = MemoryState(thread_id=thread_id, l1_tokens=0, l2_tokens=0, l3_tokens=0, updated_at=int(time.time()))
             s.add(st_row)
         return st_row
 
 
-def get_messages_since(thread_id: str, last_id: Optional[str]) -> list:
+class MessageView(NamedTuple):
+    """Detached read-only message row (content already redacted)."""
+    id: str
+    role: str
+    content: str
+    created_at: Optional[datetime]
+
+
+def get_messages_since(thread_id: str, last_id: Optional[str]) -> List[MessageView]:
+    """User/assistant messages after last_id, ASC by (created_at, id).
+    Unknown last_id falls back to the whole thread. One statement: the anchor timestamp is a
+    scalar subquery and the cut a row-value comparison on ix_messages_thread_order;
+    redaction goes into the returned view, never onto ORM rows.
+    """
+    q = (
+        select(Message.id, Message.role, Message.content, Message.created_at)
+        .where(Message.thread_id == thread_id, Message.role.in_(("user", "assistant")))
+    )
+    if last_id is not None:
+        anchor_ts = (
+            select(Message.created_at)
+            .where(Message.id == last_id, Message.thread_id == thread_id)
+            .scalar_subquery()
+        )
+        q = q.where(or_(
+            anchor_ts.is_(None),
+            tuple_(Message.created_at, Message.id) > tuple_(anchor_ts, literal(last_id)),
+        ))
     with session_scope() as s:
-        items = list(s.query(Message).filter(Message.thread_id == thread_id)
-                           .order_by(Message.created_at.asc()))
-        out: list = []
-        if last_id is None:
-            seq = items
-        else:
-            found = False
-            seq = []
-            for m in items:
-                if not found:
-                    if m.id == last_id:
-                        found = True
-                    continue
-                seq.append(m)
-            if not found:
-                seq = items  # fallback: не нашли last_id → берём все
-        for m in seq:
-            if m.role in ("user", "assistant"):
-                m.content = redact_fragment(m.content or "")
-                out.append(m)
-        return out
-
-
-def insert_l2(thread_id: str, start_msg_id: str, end_msg_id: str, text: str, tokens: int) -> L2Summary:
-    rec = L2Summary(thread_id=thread_id, start_message_id=start_msg_id, end_message_id=end_msg_id, text=text, tokens=tokens, created_at=int(datetime.now(UTC).timestamp()))
+        rows = s.execute(q.order_by(Message.created_at.asc(), Message.id.asc())).all()
+    return [MessageView(r.id, r.role, redact_fragment(r.content or ""), r.created_at) for r in rows]
+
+
+def insert_l2(thread_id: str, start_msg_id: str, end_msg_id: str, text: str, tokens: int, now: Optional[int] = None) -> L2Summary:
+    row = {"thread_id": thread_id, "start_message_id": start_msg_id, "end_message_id": end_msg_id, "text": text, "tokens": tokens, "created_at": now if now is not None else int(time.time())}
     with session_scope() as s:
-        s.add(rec)
-        s.flush()
-        return rec
+        return s.scalars(_INSERT_L2, [row]).one()
 
 
-def insert_l3(thread_id: str, start_l2_id: int, end_l2_id: int, text: str, tokens: int) -> L3MicroSummary:
-    rec = L3MicroSummary(thread_id=thread_id, start_l2_id=start_l2_id, end_l2_id=end_l2_id, text=text, tokens=tokens, created_at=int(datetime.now(UTC).timestamp()))
+def insert_l3(thread_id: str, start_l2_id: int, end_l2_id: int, text: str, tokens: int, now: Optional[int] = None) -> L3MicroSummary:
+    row = {"thread_id": thread_id, "start_l2_id": start_l2_id, "end_l2_id": end_l2_id, "text": text, "tokens": tokens, "created_at": now if now is not None else int(time.time())}
     with session_scope() as s:
-        s.add(rec)
-        s.flush()
-        return rec
+        return s.scalars(_INSERT_L3, [row]).one()
 
 
 def trim_l3_if_over(thread_id: str, max_tokens: int) -> int:
+    """Drop oldest L3 rows until the thread's L3 total fits max_tokens.
+    Single DELETE: a row goes when the running sum newest->oldest (inclusive) exceeds the cap.
+    """
+    running = func.sum(func.coalesce(L3MicroSummary.tokens, 0)).over(order_by=L3MicroSummary.id.desc())
+    # derived table rather than a CTE: sqlite3 reports rowcount=-1 for statements starting with WITH
+    c = (
+        select(L3MicroSummary.id.label("id"), running.label("running"))
+        .where(L3MicroSummary.thread_id == thread_id)
+        .subquery("c")
+    )
+    stmt = (
+        delete(L3MicroSummary)
+        .where(L3MicroSummary.id.in_(select(c.c.id).where(c.c.running > max_tokens)))
+        .execution_options(synchronize_session=False)
+    )
     with session_scope() as s:
-        q = s.query(L3MicroSummary).filter(L3MicroSummary.thread_id == thread_id).order_by(L3MicroSummary.id.asc())
-        items = list(q)
-        total = sum(x.tokens or 0 for x in items)
-        removed = 0
-        while total > max_tokens and items:
-            x = items.pop(0)
-            total -= x.tokens or 0
-            s.delete(x)
-            removed += 1
-        return removed
-
-
-def update_memory_counters(thread_id: str, l1_tokens: int, l2_tokens: int, l3_tokens: int) -> None:
+        return s.execute(stmt).rowcount or 0
+
+
+def update_memory_counters(thread_id: str, l1_tokens: int, l2_tokens: int, l3_tokens: int, now: Optional[int] = None) -> None:
     with session_scope() as s:
         st_row = s.get(MemoryState, thread_id)
         if st_row is None:
             st_row = MemoryState(thread_id=thread_id)
+            s.add(st_row)
         st_row.l1_tokens = l1_tokens
         st_row.l2_tokens = l2_tokens
         st_row.l3_tokens = l3_tokens
-        st_row.updated_at = int(datetime.now(UTC).timestamp())
-        s.add(st_row)
+        st_row.updated_at = now if now is not None else int(time.time())
 
 # Expose L2/L3 getters for context_builder if needed
 
@@ -302,52 +470,190 @@ def get_tool_run(thread_id: str, tool_name: str, args_hash: str):
     with session_scope() as s:
         return s.query(ToolRun).filter_by(thread_id=thread_id, tool_name=tool_name, args_hash=args_hash).first()
 
+def _build_tool_run(thread_id: str, attempt_id: str, tool_name: str, args_json: str, args_hash: str, result_text: str, status: str, created_at: int) -> ToolRun:
+    return ToolRun(
+        thread_id=thread_id,
+        attempt_id=attempt_id,
+        tool_name=tool_name,
+        args_json=args_json,
+        args_hash=args_hash,
+        result_text=result_text,
+        status=status,
+        created_at=created_at,
+    )
+
 def insert_tool_run(thread_id: str, attempt_id: str, tool_name: str, args_json: str, args_hash: str, result_text: str, status: str, created_at: int):
+    row = {
+        "thread_id": thread_id, "attempt_id": attempt_id, "tool_name": tool_name, "args_json": args_json,
+        "args_hash": args_hash, "result_text": result_text, "status": status, "created_at": created_at,
+    }
     with session_scope() as s:
-        run = ToolRun(
-            thread_id=thread_id,
-            attempt_id=attempt_id,
-            tool_name=tool_name,
-            args_json=args_json,
-            args_hash=args_hash,
-            result_text=result_text,
-            status=status,
-            created_at=created_at,
-        )
-        s.add(run)
-        s.commit()
-        return run
+        return s.scalars(_INSERT_TOOL_RUN, [row]).one()
+
+# ---------- Async write helpers (event loop never waits on commit/fsync) ----------
+
+WRITE_BATCH_MAX = 50
+
+
+def _add_all(objs: List[Any]) -> None:
+    with session_scope() as s:
+        s.add_all(objs)
+
+
+class _WriterQueue:
+    """Single-writer queue: one consumer per event loop drains up to WRITE_BATCH_MAX
+    pending rows and commits them in one transaction on a worker thread. A failed batch is
+    rolled back and retried row by row, so one bad row does not fail its neighbours."""
+
+    def __init__(self, batch_max: int = WRITE_BATCH_MAX) -> None:
+        self._batch_max = batch_max
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_consumer(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run(self._queue))
+        return self._queue
+
+    async def submit(self, obj: Any) -> Any:
+        queue = self._ensure_consumer()
+        fut = asyncio.get_running_loop().create_future()
+        await queue.put((obj, fut))
+        return await fut
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self._batch_max:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await asyncio.to_thread(_add_all, [obj for obj, _ in batch])
+            except Exception as exc:  # noqa: BLE001 - the batch was rolled back
+                if len(batch) == 1:
+                    _settle(batch[0][1], exc=exc)
+                    continue
+                # retry row by row so only the failing row's waiter gets the exception
+                for obj, fut in batch:
+                    try:
+                        await asyncio.to_thread(_add_all, [obj])
+                    except Exception as row_exc:  # noqa: BLE001 - delivered to this waiter
+                        _settle(fut, exc=row_exc)
+                    else:
+                        _settle(fut, obj)
+            else:
+                for obj, fut in batch:
+                    _settle(fut, obj)
+
+
+def _settle(fut: asyncio.Future, result: Any = None, exc: Optional[BaseException] = None) -> None:
+    if fut.done():  # waiter cancelled
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+_writer = _WriterQueue()
+
+# Per-thread write serialization: async writers on the same thread_id take turns, so a
+# read-check-write sequence (race checks after awaiting the LLM) sees a stable table and
+# SQLite never has two transactions of one thread competing for the write lock.
+# asyncio.Lock binds to the loop it first waits on, so locks are kept per event loop
+# (request loop, the sync-wrapper background loop, per-test loops).
+_thread_write_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Lock]]" = weakref.WeakKeyDictionary()
+
+
+def thread_write_lock(thread_id: str) -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    locks = _thread_write_locks.get(loop)
+    if locks is None:
+        locks = _thread_write_locks[loop] = defaultdict(asyncio.Lock)
+    return locks[thread_id]
+
+
+async def append_message_async(
+    thread_id: str,
+    role: str,
+    content: str,
+    tokens: Optional[Dict[str, int]] = None,
+    finish_reason: Optional[str] = None,
+    attempt: Optional[int] = None,
+) -> Optional[Message]:
+    msg = _build_message(thread_id, role, content, tokens, finish_reason, attempt)
+    if msg is None:
+        return None
+    return await _writer.submit(msg)
+
+
+async def save_response_async(**kwargs: Any) -> Response:
+    """Same keywords as save_response."""
+    return await _writer.submit(_build_response(**kwargs))
+
+
+async def insert_tool_run_async(thread_id: str, attempt_id: str, tool_name: str, args_json: str, args_hash: str, result_text: str, status: str, created_at: int) -> ToolRun:
+    return await _writer.submit(_build_tool_run(thread_id, attempt_id, tool_name, args_json, args_hash, result_text, status, created_at))
+
+
+async def insert_l2_async(thread_id: str, start_msg_id: str, end_msg_id: str, text: str, tokens: int, now: Optional[int] = None) -> L2Summary:
+    async with thread_write_lock(thread_id):
+        return await asyncio.to_thread(insert_l2, thread_id, start_msg_id, end_msg_id, text, tokens, now)
+
+
+async def insert_l3_async(thread_id: str, start_l2_id: int, end_l2_id: int, text: str, tokens: int, now: Optional[int] = None) -> L3MicroSummary:
+    async with thread_write_lock(thread_id):
+        return await asyncio.to_thread(insert_l3, thread_id, start_l2_id, end_l2_id, text, tokens, now)
+
+
+async def update_memory_counters_async(thread_id: str, l1_tokens: int, l2_tokens: int, l3_tokens: int, now: Optional[int] = None) -> None:
+    async with thread_write_lock(thread_id):
+        await asyncio.to_thread(update_memory_counters, thread_id, l1_tokens, l2_tokens, l3_tokens, now)
 
 # ---------- Async summarization helpers (HF-26B) ----------
 
+def _existing_l2_pairs(s: Session, thread_id: str, pairs: List[Tuple[str, str]]) -> set:
+    rows = s.execute(
+        select(L2Summary.start_message_id, L2Summary.end_message_id).where(
+            L2Summary.thread_id == thread_id,
+            tuple_(L2Summary.start_message_id, L2Summary.end_message_id).in_(pairs),
+        )
+    )
+    return {(u, a) for u, a in rows}
+
+
 async def ensure_l2_for_pairs(thread_id: str, pairs: List[Tuple[str, str]], lang: str, now: int) -> int:
     """Create missing L2 summaries for given (user_msg_id, assistant_msg_id) pairs.
-    No event-loop blocking (pure async summarizer usage); DB ops are sync per pair."""
+    No event-loop blocking (pure async summarizer usage). DB work is batched: one IN-query for
+    existing L2 coverage, one for message bodies, one multi-row INSERT ... RETURNING at the end."""
     if not pairs:
         return 0
     from packages.orchestration import summarizer
     from packages.orchestration.redactor import sanitize_for_memory
 
-    created = 0
-    need: List[Tuple[str,str,str,str]] = []  # (u_id,a_id,u_txt,a_txt)
+    pairs = list(dict.fromkeys(pairs))
     with session_scope() as s:
-        for (uid, aid) in pairs:
-            exists = s.query(L2Summary).filter(
-                L2Summary.thread_id == thread_id,
-                L2Summary.start_message_id == uid,
-                L2Summary.end_message_id == aid,
-            ).first()
-            if exists:
-                continue
-            um = s.get(Message, uid); am = s.get(Message, aid)
-            if not um or not am:
-                continue
-            u_txt = sanitize_for_memory(um.content or "")
-            a_txt = sanitize_for_memory(am.content or "")
-            need.append((uid, aid, u_txt, a_txt))
+        existing = _existing_l2_pairs(s, thread_id, pairs)
+        fresh = [p for p in pairs if p not in existing]
+        if not fresh:
+            return 0
+        ids = {mid for p in fresh for mid in p}
+        bodies = dict(s.execute(select(Message.id, Message.content).where(Message.id.in_(ids))).all())
+    need: List[Tuple[str,str,str,str]] = [  # (u_id,a_id,u_txt,a_txt)
+        (uid, aid, sanitize_for_memory(bodies[uid] or ""), sanitize_for_memory(bodies[aid] or ""))
+        for (uid, aid) in fresh
+        if uid in bodies and aid in bodies
+    ]
     if not need:
         return 0
 
+    texts: List[str] = []
     for (uid, aid, u_txt, a_txt) in need:
         try:
             l2_text = await summarizer.summarize_pair_to_l2(u_txt, a_txt, lang or "ru")
@@ -355,19 +661,27 @@ async def ensure_l2_for_pairs(thread_id: str, pairs: List[Tuple[str, str]], lang
             u_short = (u_txt.strip().splitlines() or [""])[0][:200]
             a_short = (a_txt.strip().splitlines() or [""])[0][:200]
             l2_text = f"- {u_short} → {a_short}"
+        texts.append(l2_text)
+    rows: List[Dict[str, Any]] = [
+        {
+            "thread_id": thread_id, "start_message_id": uid, "end_message_id": aid,
+            "text": text, "tokens": toks, "created_at": now,
+        }
+        for (uid, aid, _, _), text, toks in zip(need, texts, approx_tokens_batch(texts))
+    ]
+
+    def _write() -> int:
         with session_scope() as s:
-            # race check
-            exists = s.query(L2Summary).filter(
-                L2Summary.thread_id == thread_id,
-                L2Summary.start_message_id == uid,
-                L2Summary.end_message_id == aid,
-            ).first()
-            if exists:
-                continue
-            rec = L2Summary(thread_id=thread_id, start_message_id=uid, end_message_id=aid, text=l2_text, tokens=approx_tokens(l2_text), created_at=now)
-            s.add(rec)
-            created += 1
-    return created
+            # race check: another writer may have covered some pairs while we awaited the LLM
+            raced = _existing_l2_pairs(s, thread_id, [(r["start_message_id"], r["end_message_id"]) for r in rows])
+            fresh_rows = [r for r in rows if (r["start_message_id"], r["end_message_id"]) not in raced]
+            if not fresh_rows:
+                return 0
+            # insertmanyvalues: all rows and their ids in a single statement
+            return len(s.scalars(_INSERT_L2_IDS, fresh_rows).all())
+
+    async with thread_write_lock(thread_id):
+        return await asyncio.to_thread(_write)
 
 async def ensure_l2_for_pairs_grouped(thread_id: str,
                                       pairs_seq: List[Tuple[str, str]],
@@ -433,24 +747,107 @@ async def ensure_l2_for_pairs_grouped(thread_id: str,
         i += group_size
     return {"groups": created_groups, "pairs": created_pairs}
 
+async def promote_l2_to_l3(thread_id: str, l2_ids: List[int], lang: str, now: int) -> int:
+    """Condense the given L2 records into one L3 micro summary and drop them.
+    Awaits the summarizer directly (no loop detection / naive fallback in async callers).
+    Returns the number of L2 records promoted."""
+    if not l2_ids:
+        return 0
+    from packages.orchestration import summarizer
+
+    # plain read: a concurrent promoter is caught by the DELETE ... RETURNING check in _write
+    with session_scope() as s:
+        items = s.execute(
+            select(L2Summary.id, L2Summary.text)
+            .where(L2Summary.thread_id == thread_id, L2Summary.id.in_(l2_ids))
+            .order_by(L2Summary.id.asc())
+        ).all()
+    if not items:
+        return 0
+    texts = [x.text or "" for x in items]
+    try:
+        l3_text = await summarizer.summarize_l2_block_to_l3(texts, lang or "ru")
+    except Exception:
+        l3_text = "\n".join(f"• {(t.splitlines() or [''])[0][:160]}" for t in texts[:2])
+
+    def _write() -> int:
+        with session_scope() as s:
+            # DELETE ... RETURNING doubles as the race check: only rows still present come back
+            ids = list(s.scalars(
+                delete(L2Summary)
+                .where(L2Summary.thread_id == thread_id, L2Summary.id.in_([x.id for x in items]))
+                .returning(L2Summary.id)
+                .execution_options(synchronize_session=False)
+            ))
+            if not ids:
+                return 0
+            s.execute(_INSERT_L3, [{
+                "thread_id": thread_id, "start_l2_id": min(ids), "end_l2_id": max(ids),
+                "text": l3_text, "tokens": approx_tokens(l3_text), "created_at": now,
+            }])
+            return len(ids)
+
+    async with thread_write_lock(thread_id):
+        return await asyncio.to_thread(_write)
+
 # Sync wrappers (if needed by legacy sync code)
+# One persistent loop on a daemon thread: no per-call loop setup/teardown (asyncio.run).
+# Sync callers only: on a thread with a running loop, blocking on the result would stall that
+# loop, so such callers must await the async function instead.
+
+_bg_loop: Optional[asyncio.AbstractEventLoop] = None
+_bg_loop_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _bg_loop
+    with _bg_loop_lock:
+        if _bg_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="repo-sync-loop", daemon=True).start()
+            _bg_loop = loop
+        return _bg_loop
+
+
+def _run_sync(coro: Any) -> Any:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        name = getattr(coro, "__qualname__", "the coroutine")
+        coro.close()
+        raise RuntimeError(f"sync repo wrapper called from a running event loop; await {name}() instead")
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
 
 def ensure_l2_for_pairs_sync(thread_id: str, pairs: List[Tuple[str,str]], lang: str, now: int) -> int:
-    return asyncio.run(ensure_l2_for_pairs(thread_id, pairs, lang, now))
+    return _run_sync(ensure_l2_for_pairs(thread_id, pairs, lang, now))
 
 def promote_l2_to_l3_sync(thread_id: str, l2_ids: List[int], lang: str, now: int) -> int:
-    return asyncio.run(promote_l2_to_l3(thread_id, l2_ids, lang, now))
+    return _run_sync(promote_l2_to_l3(thread_id, l2_ids, lang, now))
 
 # Existing legacy sync versions were removed to avoid run_until_complete blocking.
 
 # Additional summarization post-reply helpers
 
 def insert_l2_summary(thread_id: str, start_msg_id: str, end_msg_id: str, text: str, now: int):
-    from packages.utils.tokens import approx_tokens
+    return insert_l2_summaries_bulk(thread_id, [{"start_msg_id": start_msg_id, "end_msg_id": end_msg_id, "text": text, "now": now}])[0]
+
+
+def insert_l2_summaries_bulk(thread_id: str, rows: List[Dict[str, Any]]) -> List[L2Summary]:
+    """Insert many L2 summaries in one statement (insertmanyvalues), one transaction.
+    rows: dicts with start_msg_id/end_msg_id/text and optional now; returned in input order."""
+    if not rows:
+        return []
+    ts = int(time.time())
+    toks = approx_tokens_batch([r["text"] for r in rows])
+    params = [
+        {"thread_id": thread_id, "start_message_id": r["start_msg_id"], "end_message_id": r["end_msg_id"],
+         "text": r["text"], "tokens": tk, "created_at": r.get("now") if r.get("now") is not None else ts}
+        for r, tk in zip(rows, toks)
+    ]
     with session_scope() as s:
-        rec = L2Summary(thread_id=thread_id, start_message_id=start_msg_id, end_message_id=end_msg_id, text=text, tokens=approx_tokens(text), created_at=now)
-        s.add(rec)
-        return rec
+        return list(s.scalars(_INSERT_L2_MANY, params).all())
 
 
 def pick_oldest_l2_block(thread_id: str, max_items: int = 5):
@@ -460,62 +857,74 @@ def pick_oldest_l2_block(thread_id: str, max_items: int = 5):
 
 
 def insert_l3_summary(thread_id: str, l2_ids: list[int], text: str, now: int):
-    from packages.utils.tokens import approx_tokens
     if not l2_ids:
         return None
+    return insert_l3_summaries_bulk(thread_id, [{"l2_ids": l2_ids, "text": text, "now": now}])[0]
+
+
+def insert_l3_summaries_bulk(thread_id: str, rows: List[Dict[str, Any]]) -> List[L3MicroSummary]:
+    """Bulk counterpart of insert_l3_summary: rows are dicts with l2_ids/text and optional now.
+    Rows with empty l2_ids are skipped (as insert_l3_summary returns None for them)."""
+    rows = [r for r in rows if r.get("l2_ids")]
+    if not rows:
+        return []
+    ts = int(time.time())
+    toks = approx_tokens_batch([r["text"] for r in rows])
+    params = [
+        {"thread_id": thread_id, "start_l2_id": min(r["l2_ids"]), "end_l2_id": max(r["l2_ids"]),
+         "text": r["text"], "tokens": tk, "created_at": r.get("now") if r.get("now") is not None else ts}
+        for r, tk in zip(rows, toks)
+    ]
     with session_scope() as s:
-        start_id = min(l2_ids); end_id = max(l2_ids)
-        rec = L3MicroSummary(thread_id=thread_id, start_l2_id=start_id, end_l2_id=end_id, text=text, tokens=approx_tokens(text), created_at=now)
-        s.add(rec)
-        return rec
+        return list(s.scalars(_INSERT_L3_MANY, params).all())
 
 
 def delete_l2_batch(l2_ids: list[int]):
     if not l2_ids:
         return 0
+    stmt = delete(L2Summary).where(L2Summary.id.in_(l2_ids)).execution_options(synchronize_session=False)
     with session_scope() as s:
-        cnt = 0
-        for _id in l2_ids:
-            row = s.get(L2Summary, _id)
-            if row:
-                s.delete(row); cnt += 1
-        return cnt
+        return s.execute(stmt).rowcount or 0
 
 
 def evict_l3_oldest(thread_id: str, count: int = 3) -> int:
+    oldest = (
+        select(L3MicroSummary.id)
+        .where(L3MicroSummary.thread_id == thread_id)
+        .order_by(L3MicroSummary.id.asc())
+        .limit(count)
+    )
+    stmt = delete(L3MicroSummary).where(L3MicroSummary.id.in_(oldest)).execution_options(synchronize_session=False)
     with session_scope() as s:
-        q = s.query(L3MicroSummary).filter(L3MicroSummary.thread_id == thread_id).order_by(L3MicroSummary.id.asc()).limit(count)
-        items = list(q)
-        for it in items:
-            s.delete(it)
-        return len(items)
+        return s.execute(stmt).rowcount or 0
 
 # NEW: full history fetch for L1 tail building
 
-def get_thread_messages_for_l1(thread_id: str, exclude_message_id: str | None = None, max_items: int = 2000):
-    """Return entire user/assistant history (ASC by time,id), optionally excluding current (and newer) message.
-    Sanitizes content via redact_fragment (<think> removal). Returns tail limited by max_items.
+def get_thread_messages_for_l1(thread_id: str, exclude_message_id: str | None = None, max_items: int = 2000) -> List[MessageView]:
+    """Return user/assistant history tail (ASC by time,id), optionally excluding current (and newer) message.
+    One keyset statement on ix_messages_thread_order: the cut is a row-value comparison against
+    a scalar subquery (unknown id -> no cut), the tail is DESC + LIMIT reversed here, so no
+    sorting happens in Python. Content is sanitized via redact_fragment (<think> removal)
+    into read-only views, never onto ORM rows.
     """
-    with session_scope() as s:
-        q = (
-            s.query(Message)
-             .filter(
-                 Message.thread_id == thread_id,
-                 Message.role.in_(("user", "assistant"))
-             )
-             .order_by(Message.created_at.asc(), Message.id.asc())
+    q = (
+        select(Message.id, Message.role, Message.content, Message.created_at)
+        .where(Message.thread_id == thread_id, Message.role.in_(("user", "assistant")))
+    )
+    if exclude_message_id:
+        cut_ts = (
+            select(Message.created_at)
+            .where(Message.id == exclude_message_id, Message.thread_id == thread_id)
+            .scalar_subquery()
         )
-        items = list(q)
-        if exclude_message_id:
-            trimmed = []
-            for m in items:
-                if m.id == exclude_message_id:
-                    break
-                trimmed.append(m)
-            items = trimmed
-        for m in items:
-            m.content = redact_fragment(m.content or "")
-        return items[-max_items:]
+        q = q.where(or_(
+            cut_ts.is_(None),
+            tuple_(Message.created_at, Message.id) < tuple_(cut_ts, literal(exclude_message_id)),
+        ))
+    with session_scope() as s:
+        rows = s.execute(q.order_by(Message.created_at.desc(), Message.id.desc()).limit(max_items)).all()
+    rows.reverse()
+    return [MessageView(r.id, r.role, redact_fragment(r.content or ""), r.created_at) for r in rows]
 
 
 def get_l2_for_thread(thread_id: str, limit: int = 200):
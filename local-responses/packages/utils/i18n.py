@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from functools import lru_cache
+
 STRINGS = {
     "en": {
         "instruction": "Follow the rules. Do not reveal chain-of-thought. Answer and think in the user's language.",
@@ -19,10 +21,20 @@ STRINGS = {
     },
 }
 
+# (lang, key) -> text; unknown languages resolve through the "en" entries
+_FLAT = {(lang, key): text for lang, d in STRINGS.items() for key, text in d.items()}
+
+
+@lru_cache(maxsize=64)
 def pick_lang(last_user_lang: str | None, preferred: str | None) -> str:
     lang = (last_user_lang or preferred or "en").lower()
     return "ru" if lang.startswith("ru") else "en"
 
 
 def t(lang: str, key: str) -> str:
-    return STRINGS.get(lang, STRINGS["en"]).get(key, key.upper())
+    text = _FLAT.get((lang, key))
+    if text is None:
+        text = _FLAT.get(("en", key)) if lang not in STRINGS else None
+        if text is None:
+            return key.upper()
+    return text
@@ -1,21 +1,123 @@
 # packages/utils/tokens.py
 from __future__ import annotations
 
-import math
-from typing import Any, Dict, List
+import asyncio
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Any, Dict, List, Sequence
+
+try:  # optional C parser (speedups extra)
+    import orjson  # type: ignore[import-not-found]
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+try:  # optional BPE tokenizer (speedups extra)
+    import tiktoken  # type: ignore[import-not-found]
+except ImportError:  # pragma: no cover
+    tiktoken = None  # type: ignore[assignment]
+
+_json_dumps = partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
 
 
 def approx_tokens(text: str) -> int:
-    """Rough token estimate: 1 token ~= 4 chars."""
-    return int(math.ceil(len(text or "") / 4))
+    """Rough token estimate: 1 token ~= 4 chars (integer ceil, no float)."""
+    return (len(text or "") + 3) // 4
+
+
+@lru_cache(maxsize=1)
+def _bpe_encoder():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # e.g. offline and no cached BPE ranks
+        return None
+
+
+async def load_bpe_encoder() -> None:
+    """Load the BPE ranks in a worker thread (file/network I/O) so estimate_tokens never does it
+    on the event loop. Called at app startup and before context assembly; a no-op once loaded."""
+    if tiktoken is not None and _bpe_encoder.cache_info().currsize == 0:
+        await asyncio.to_thread(_bpe_encoder)
+
+
+# BPE counts keyed on a 16-byte digest, not the text: long tool results are not kept alive
+_ESTIMATE_CACHE_MAX = 4096
+_estimate_cache: "OrderedDict[bytes, int]" = OrderedDict()
+_estimate_cache_lock = threading.Lock()
+
+
+def clear_estimate_cache() -> None:
+    with _estimate_cache_lock:
+        _estimate_cache.clear()
+
+
+def estimate_tokens(text: str) -> int:
+    """BPE token count (cl100k_base) when tiktoken is available, approx_tokens otherwise.
+
+    Cached: core profile / tool results / history text repeats across turns of a thread.
+    """
+    enc = _bpe_encoder()
+    if enc is None or not text:
+        return approx_tokens(text)
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _estimate_cache_lock:
+        n = _estimate_cache.get(key)
+        if n is not None:
+            _estimate_cache.move_to_end(key)
+            return n
+    n = len(enc.encode(text, disallowed_special=()))
+    with _estimate_cache_lock:
+        _estimate_cache[key] = n
+        if len(_estimate_cache) > _ESTIMATE_CACHE_MAX:
+            _estimate_cache.popitem(last=False)
+    return n
+
+
+def estimate_tokens_batch(texts: Sequence[str]) -> List[int]:
+    """estimate_tokens for many strings; same units as the context token breakdown."""
+    if _bpe_encoder() is None:
+        return approx_tokens_batch(texts)
+    return [estimate_tokens(t) for t in texts]
+
+
+def approx_tokens_batch(texts: Sequence[str]) -> List[int]:
+    """approx_tokens for many strings in one pass."""
+    return [(len(t) + 3) // 4 if t else 0 for t in texts]
 
 
 def approx_tokens_messages(messages: List[Dict[str, Any]]) -> int:
     """Heuristic prompt tokens for chat-style messages (sum of contents)."""
-    total = 0
-    for m in messages or []:
-        total += approx_tokens(str(m.get("content", "")))
-    return total
+    return sum(approx_tokens_batch([str(m.get("content", "")) for m in messages or []]))
+
+
+def estimate_tokens_messages(messages: List[Dict[str, Any]]) -> int:
+    """estimate_tokens for chat-style messages (sum of contents)."""
+    return sum(estimate_tokens_batch([str(m.get("content", "")) for m in messages or []]))
+
+
+# (label, profile key) in output order
+_PROFILE_FIELDS = (
+    ("User Name", "display_name"),
+    ("Language", "preferred_language"),
+    ("Tone", "tone"),
+    ("Timezone", "timezone"),
+    ("Region", "region_coarse"),
+    ("WorkHours", "work_hours"),
+    ("UI", "ui_format_prefs"),
+    ("Goals/Mood", "goals_mood"),
+    ("Decisions/Tasks", "decisions_tasks"),
+    ("Brevity", "brevity"),
+    ("FormatDefaults", "format_defaults"),
+    ("Interests", "interests_topics"),
+    ("WorkflowTools", "workflow_tools"),
+    ("OS", "os"),
+    ("Runtime", "runtime"),
+    ("HW", "hardware_hint"),
+)
 
 
 def profile_text_view(profile: Dict[str, Any]) -> str:
@@ -26,34 +128,26 @@ def profile_text_view(profile: Dict[str, Any]) -> str:
     """
     lines = []
     add = lines.append
-    def norm(v: Any) -> str:
+    get = profile.get
+    for label, key in _PROFILE_FIELDS:
+        v = get(key)
         if v is None:
-            return ""
-        if isinstance(v, (dict, list)):
-            return json_dumps(v)
-        return str(v)
-
-    # Ordered sections
-    add(f"User Name: {norm(profile.get('display_name'))}")
-    add(f"Language: {norm(profile.get('preferred_language'))}")
-    add(f"Tone: {norm(profile.get('tone'))}")
-    add(f"Timezone: {norm(profile.get('timezone'))}")
-    add(f"Region: {norm(profile.get('region_coarse'))}")
-    add(f"WorkHours: {norm(profile.get('work_hours'))}")
-    add(f"UI: {norm(profile.get('ui_format_prefs'))}")
-    add(f"Goals/Mood: {norm(profile.get('goals_mood'))}")
-    add(f"Decisions/Tasks: {norm(profile.get('decisions_tasks'))}")
-    add(f"Brevity: {norm(profile.get('brevity'))}")
-    add(f"FormatDefaults: {norm(profile.get('format_defaults'))}")
-    add(f"Interests: {norm(profile.get('interests_topics'))}")
-    add(f"WorkflowTools: {norm(profile.get('workflow_tools'))}")
-    add(f"OS: {norm(profile.get('os'))}")
-    add(f"Runtime: {norm(profile.get('runtime'))}")
-    add(f"HW: {norm(profile.get('hardware_hint'))}")
-    text = "\n".join(lines).strip()
-    return text
+            add(f"{label}: ")
+        elif isinstance(v, (dict, list)):
+            add(f"{label}: {json_dumps(v)}")
+        else:
+            add(f"{label}: {v}")
+    return "\n".join(lines).strip()
 
 
 def json_dumps(obj: Any) -> str:
-    import json
-    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    """Compact JSON with non-ASCII kept as is. Always the stdlib encoder: the output is stored
+    (request/response JSON) and orjson writes floats (1e-07 vs 1e-7) and NaN (null) differently."""
+    return _json_dumps(obj)
+
+
+def json_loads(data: str | bytes | bytearray) -> Any:
+    """Parse JSON from str or bytes; orjson when installed. Bad input raises ValueError either way."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
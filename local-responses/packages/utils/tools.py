@@ -1,12 +1,28 @@
 import json
 import hashlib
 
+def canon_args_bytes(obj) -> bytes:
+    """Canonical UTF-8 JSON of tool args: sorted keys, compact separators, no ASCII escaping.
+    Always the stdlib encoder: args_hash is a stored cache key, and orjson writes floats
+    (1e-07 vs 1e-7) and NaN/Infinity (null) differently, so the bytes must not depend on extras."""
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 def canon_args(obj) -> str:
-    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return canon_args_bytes(obj).decode("utf-8")
+
+# direct constructors: skip hashlib.new() name dispatch on the common algorithms
+_HASHERS = {
+    "sha256": hashlib.sha256,
+    "sha1": hashlib.sha1,
+    "blake2b": hashlib.blake2b,
+}
 
 def args_hash(obj, algo="sha256") -> str:
-    s = canon_args(obj).encode("utf-8")
-    return hashlib.new(algo, s).hexdigest()
+    s = canon_args_bytes(obj)
+    hasher = _HASHERS.get(algo)
+    if hasher is None:
+        return hashlib.new(algo, s).hexdigest()
+    return hasher(s).hexdigest()
 
 def is_valid_tool_json(s: str) -> tuple[bool, dict|None]:
     try:
@@ -0,0 +1,164 @@
+# tests/conftest.py
+from __future__ import annotations
+
+import atexit
+import os
+import shutil
+import tempfile
+
+import pytest
+import pytest_asyncio
+from httpx import AsyncClient, ASGITransport
+
+# Fresh SQLite file per run on tmpfs (RAM) when available, set before packages.storage.repo
+# builds its engine. A real file keeps WAL and per-connection isolation, which a shared
+# ':memory:' database does not; DB_URL from the environment still wins.
+if "DB_URL" not in os.environ:
+    _TEST_DB_DIR = tempfile.mkdtemp(prefix="lr-tests-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    os.environ["DB_URL"] = f"sqlite:///{_TEST_DB_DIR}/app.db"
+    atexit.register(shutil.rmtree, _TEST_DB_DIR, ignore_errors=True)
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def api_client():
+    """One ASGI client for the whole run; ASGITransport keeps no loop-bound state."""
+    from apps.api.main import app
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        yield ac
+
+
+@pytest.fixture(autouse=True)
+def _clear_budget_caches():
+    """compute_budgets results and LM Studio model info live in module-level caches; drop
+    both around every test so a window cached by one test never leaks into the next."""
+    from packages.orchestration.budget import clear_budget_cache
+    from packages.providers.lmstudio_cache import clear_cache
+
+    clear_budget_cache()
+    clear_cache()
+    yield
+    clear_budget_cache()
+    clear_cache()
+
+
+@pytest.fixture
+def app_settings():
+    """Fresh settings (current env) injected into the routes; no app reload needed."""
+    from apps.api.main import app
+    from packages.core.settings import get_settings
+
+    get_settings.cache_clear()
+    st = get_settings()
+    app.dependency_overrides[get_settings] = lambda: st
+    yield st
+    app.dependency_overrides.pop(get_settings, None)
+
+
+@pytest.fixture
+def settings_env(monkeypatch):
+    """settings_env(NAME=value, ...) -> get_settings() rebuilt with those env vars set through
+    monkeypatch (test-local, safe under xdist); the cache is dropped again at teardown."""
+    from packages.core.settings import get_settings
+
+    def _apply(**env):
+        for k, v in env.items():
+            monkeypatch.setenv(k, str(v))
+        get_settings.cache_clear()
+        return get_settings()
+    yield _apply
+    get_settings.cache_clear()
+
+
+@pytest.fixture(scope="module")
+def api_app():
+    """(app, settings) shared by a test module: env pinned and settings rebuilt once, injected
+    through dependency_overrides; the app module is never reloaded."""
+    from apps.api.main import app
+    from packages.core.settings import get_settings
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("LMSTUDIO_BASE_URL", os.environ.get("LMSTUDIO_BASE_URL") or "http://127.0.0.1:1234")
+        get_settings.cache_clear()
+        st = get_settings()
+        app.dependency_overrides[get_settings] = lambda: st
+        yield app, st
+        app.dependency_overrides.pop(get_settings, None)
+    get_settings.cache_clear()
+
+
+@pytest.fixture
+def lmstudio_mock(respx_mock):
+    """lmstudio_mock(base_url, body=None, *, json=None, side_effect=None) -> respx route for
+    POST {base_url}/v1/chat/completions: bytes body = raw SSE stream, json = non-stream reply.
+    Host-bound on purpose: token counting posts to the same path on its own base URL."""
+    from httpx import Response
+
+    def _mk(base_url, body: bytes | None = None, *, json=None, side_effect=None):
+        route = respx_mock.post(f"{str(base_url).rstrip('/')}/v1/chat/completions")
+        if side_effect is not None:
+            return route.mock(side_effect=side_effect)
+        if json is not None:
+            return route.mock(return_value=Response(200, json=json))
+        return route.mock(return_value=Response(200, content=body))
+    return _mk
+
+
+@pytest.fixture
+def db_session():
+    """Per-test transaction, rolled back at teardown so the test leaves no rows.
+
+    session_scope() calls on this thread join it (repo request-session hook); commits inside
+    become SAVEPOINT releases. Code that writes from worker threads / the writer queue opens
+    its own connection and must not use this fixture (SQLite would block on the write lock).
+    """
+    from sqlalchemy.orm import Session
+    from packages.storage import repo
+
+    conn = repo.engine.connect()
+    sqlite = conn.dialect.name == "sqlite"
+    if sqlite:
+        # pysqlite defers BEGIN until the first DML, so the first SAVEPOINT would be outermost
+        # and its RELEASE would commit; open a real transaction up front instead
+        dbapi_conn = conn.connection.driver_connection
+        prev_isolation = dbapi_conn.isolation_level
+        dbapi_conn.isolation_level = None
+    trans = conn.begin()
+    if sqlite:
+        conn.exec_driver_sql("BEGIN")
+    sess = Session(bind=conn, expire_on_commit=False, join_transaction_mode="create_savepoint")
+    holder = repo._RequestSession(sess)
+    token = repo._request_session.set(holder)
+    try:
+        yield sess
+    finally:
+        holder.open = False
+        repo._request_session.reset(token)
+        sess.close()
+        trans.rollback()
+        if sqlite:
+            dbapi_conn.isolation_level = prev_isolation
+        conn.close()
+
+
+DEFAULT_BUDGET = {
+    'C_eff': 4096, 'R_out': 512, 'R_sys': 256, 'Safety': 256,
+    'B_work': 1000, 'core_sys_pad': 100, 'core_tokens': 0, 'core_cap': 500,
+}
+
+
+@pytest.fixture
+def fake_budgets(monkeypatch):
+    """fake_budgets(**overrides) patches context_builder.compute_budgets with a fixed dict.
+    B_total_in defaults to C_eff - R_out - R_sys - Safety."""
+    import packages.orchestration.context_builder as cb
+
+    def _apply(**overrides):
+        budget = {**DEFAULT_BUDGET, **overrides}
+        budget.setdefault('B_total_in', budget['C_eff'] - budget['R_out'] - budget['R_sys'] - budget['Safety'])
+
+        async def _f(*a, **kw):
+            return dict(budget)
+        monkeypatch.setattr(cb, 'compute_budgets', _f)
+        return budget
+    return _apply
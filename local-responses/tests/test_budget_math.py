@@ -52,3 +52,24 @@ async def test_budget_defaults_when_no_info(monkeypatch):
     bti = b['B_total_in']
     assert b['core_reserved'] == min(6000 + s.ctx_core_sys_pad_tok, max(0, bti))
     assert b['B_work'] == max(0, bti - b['core_reserved'])
+
+
+@pytest.mark.asyncio
+async def test_compute_budgets_cached_for_loaded_model(monkeypatch):
+    import packages.orchestration.budget as budget_mod
+    calls = []
+
+    async def fake_info(model_id: str):
+        calls.append(model_id)
+        return {"loaded_context_length": 8192, "max_context_length": 32768, "state": "loaded", "source": "lmstudio"}
+    monkeypatch.setattr(budget_mod, '_get_model_info_cached', fake_info)
+
+    s = DummySettings()
+    b1 = await compute_budgets("lm:cached", 256, core_tokens=10, core_cap=11, settings=s)
+    b1['C_eff'] = -1  # callers get copies
+    b2 = await compute_budgets("lm:cached", 256, core_tokens=10, core_cap=11, settings=s)
+    assert calls == ["lm:cached"] and b2['C_eff'] == 8192
+    # other settings instance or other args -> recomputed
+    await compute_budgets("lm:cached", 256, core_tokens=10, core_cap=11, settings=DummySettings())
+    await compute_budgets("lm:cached", 512, core_tokens=10, core_cap=11, settings=s)
+    assert len(calls) == 3
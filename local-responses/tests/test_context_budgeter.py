@@ -1,16 +1,21 @@
 # tests/test_context_budgeter.py
 from __future__ import annotations
 
-from packages.storage.repo import create_thread, append_message
+from packages.storage.repo import create_thread, append_message, append_messages_bulk
 from packages.orchestration.context_manager import build_context
 
 
 def test_context_budgeter_limits_tokens() -> None:
     th = create_thread(None)
     # Create many messages to exceed budget
-    for i in range(50):
-        append_message(th.id, "user", f"msg {i} " + ("x" * 50))
-        append_message(th.id, "assistant", f"resp {i} " + ("y" * 50))
+    append_messages_bulk(th.id, [
+        m
+        for i in range(50)
+        for m in (
+            {"role": "user", "content": f"msg {i} " + ("x" * 50)},
+            {"role": "assistant", "content": f"resp {i} " + ("y" * 50)},
+        )
+    ])
 
     ctx = build_context(th.id)
     total_chars = len(ctx["system"]) + sum(len(m["content"]) for m in ctx["messages"])
@@ -31,3 +36,28 @@ def test_context_uses_summary_if_present() -> None:
 
     ctx = build_context(th.id)
     assert ctx["system"].startswith("This is summary")
+
+
+def test_context_window_follows_the_tail() -> None:
+    from packages.storage.repo import fetch_context
+
+    th = create_thread(None)
+    append_messages_bulk(th.id, [{"role": "user", "content": f"{i:02d}" + "x" * 398} for i in range(12)])  # ~100 tokens each
+    ctx = fetch_context(th.id, 1000)
+    heads = [m["content"][:2] for m in ctx["messages"]]
+    # newest first until the budget (system prompt included) is spent, returned oldest-first
+    assert heads == [f"{i:02d}" for i in range(3, 12)]
+    assert fetch_context(th.id, 1000) == ctx
+
+
+def test_context_keeps_newest_even_if_over_budget() -> None:
+    from packages.storage.repo import fetch_context
+
+    th = create_thread(None)
+    append_messages_bulk(th.id, [
+        {"role": "user", "content": "old"},
+        {"role": "assistant", "content": "<think>hidden</think>" + "z" * 4000},
+    ])
+    ctx = fetch_context(th.id, 200)
+    assert [m["role"] for m in ctx["messages"]] == ["assistant"]
+    assert ctx["messages"][0]["content"] == "z" * 4000
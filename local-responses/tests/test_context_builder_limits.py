@@ -5,16 +5,9 @@ import pytest
 from packages.orchestration.context_builder import assemble_context
 
 @pytest.mark.asyncio
-async def test_context_small_window_squeezes(monkeypatch):
-    # monkeypatch budgets to small window
-    async def fake_budgets(model_id, mot, core_tokens, core_cap, settings=None):
-        return {
-            'C_eff': 2048, 'R_out': 256, 'R_sys': 256, 'Safety': 128,
-            'B_total_in': 2048-256-256-128, 'B_work': 800, 'core_sys_pad': 100,
-            'core_tokens': 0, 'core_cap': 200,
-        }
-    import packages.orchestration.context_builder as cb
-    monkeypatch.setattr(cb, 'compute_budgets', fake_budgets)
+async def test_context_small_window_squeezes(fake_budgets):
+    # small window
+    fake_budgets(C_eff=2048, R_out=256, R_sys=256, Safety=128, B_work=800, core_cap=200)
 
     out = await assemble_context('thread_dummy', 'lm:qwen/qwen3-14b', max_output_tokens=128, tool_results_text='T'*5000, tool_results_tokens=None, last_user_lang='ru')
     stats = out['stats']
@@ -24,15 +17,8 @@ async def test_context_small_window_squeezes(monkeypatch):
     assert isinstance(stats['squeezes'], list)
 
 @pytest.mark.asyncio
-async def test_context_large_window_no_squeeze(monkeypatch):
-    async def fake_budgets(model_id, mot, core_tokens, core_cap, settings=None):
-        return {
-            'C_eff': 32768, 'R_out': 1024, 'R_sys': 256, 'Safety': 256,
-            'B_total_in': 32768-1024-256-256, 'B_work': 10000, 'core_sys_pad': 100,
-            'core_tokens': 0, 'core_cap': 2000,
-        }
-    import packages.orchestration.context_builder as cb
-    monkeypatch.setattr(cb, 'compute_budgets', fake_budgets)
+async def test_context_large_window_no_squeeze(fake_budgets):
+    fake_budgets(C_eff=32768, R_out=1024, B_work=10000, core_cap=2000)
 
     out = await assemble_context('thread_dummy', 'lm:qwen/qwen3-14b', max_output_tokens=128, tool_results_text='tools', tool_results_tokens=None, last_user_lang='en')
     stats = out['stats']
@@ -40,20 +26,108 @@ async def test_context_large_window_no_squeeze(monkeypatch):
     assert stats['tokens']['total_in'] + stats['budget']['R_out'] + stats['budget']['R_sys'] + stats['budget']['Safety'] <= stats['budget']['C_eff']
 
 @pytest.mark.asyncio
-async def test_effective_out_cap_raises_when_space(monkeypatch):
+async def test_effective_out_cap_raises_when_space(fake_budgets):
     # Lots of free space: tiny input context, large C_eff
-    async def fake_budgets(model_id, mot, core_tokens, core_cap, settings=None):
-        return {
-            'C_eff': 8192, 'R_out': 2048, 'R_sys': 128, 'Safety': 128,
-            'B_total_in': 8192-2048-128-128, 'B_work': 2000, 'core_sys_pad': 100,
-            'core_tokens': 0, 'core_cap': 500,
-            'effective_max_output_tokens': 256,
-        }
-    import packages.orchestration.context_builder as cb
-    monkeypatch.setattr(cb, 'compute_budgets', fake_budgets)
+    fake_budgets(C_eff=8192, R_out=2048, R_sys=128, Safety=128, B_work=2000, effective_max_output_tokens=256)
 
     out = await assemble_context('thread_dummy', 'lm:qwen/qwen3-14b', max_output_tokens=4096, tool_results_text=None, tool_results_tokens=None, last_user_lang='en')
     free_out_cap = out['stats']['free_out_cap']
     assert isinstance(free_out_cap, int) and free_out_cap > 0
     stats = out['stats']
     assert stats['tokens']['total_in'] + stats['budget']['R_out'] + stats['budget']['R_sys'] + stats['budget']['Safety'] <= stats['budget']['C_eff']
+
+
+def test_allocate_keep_tokens_single_pass():
+    from packages.orchestration.context_builder import allocate_keep_tokens
+
+    sections = [('tools', 1.0, 400, 0), ('l2', 3.0, 200, 0), ('l1', 4.0, 400, 100)]
+    keep = allocate_keep_tokens(sections, 500)
+    assert sum(keep.values()) <= 500
+    assert keep['l1'] >= 100 and keep['tools'] < keep['l1']
+    # enough budget: nothing trimmed; no budget: only floors survive
+    assert allocate_keep_tokens(sections, 2000) == {'tools': 400, 'l2': 200, 'l1': 400}
+    assert allocate_keep_tokens(sections, 0) == {'tools': 0, 'l2': 0, 'l1': 100}
+
+
+@pytest.mark.asyncio
+async def test_l1_fill_counts_in_few_passes(monkeypatch, fake_budgets):
+    import packages.orchestration.context_builder as cb
+    from packages.providers import lmstudio_tokens
+    from packages.storage.repo import create_thread, append_messages_bulk
+
+    fake_budgets(C_eff=32768, R_out=1024, B_work=2000, core_cap=2000)
+    def no_proxy(*a, **k):
+        raise RuntimeError("offline")
+    calls = []
+    def counting(model_id, blocks):
+        calls.append(len(blocks.get('l1', [])))
+        return real(model_id, blocks)
+    real = cb.tokens_breakdown
+    monkeypatch.setattr(lmstudio_tokens, 'count_tokens_chat', no_proxy)
+    monkeypatch.setattr(cb, 'tokens_breakdown', counting)
+    monkeypatch.setattr(cb.get_settings(), 'SUMMARIZE_INSTEAD_OF_TRIM', False)
+
+    th = create_thread(None)
+    append_messages_bulk(th.id, [
+        m for i in range(60)
+        for m in ({'role': 'user', 'content': f'u{i} ' + 'x' * 80}, {'role': 'assistant', 'content': f'a{i} ' + 'y' * 80})
+    ])
+    out = await cb.assemble_context(th.id, 'lm:qwen/qwen3-14b', max_output_tokens=128, last_user_lang='en')
+    stats = out['stats']
+    assert 0 < stats['l1_pairs_count'] < 60
+    assert stats['tokens']['l1'] <= stats['caps']['l1'] or stats['l1_pairs_count'] <= 2
+    assert len(calls) <= 5  # base + confirm + one probe up + compactor/squeeze, not one per pair
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("skew", [3.0, 0.3])
+async def test_l1_cut_matches_greedy_when_estimate_is_off(monkeypatch, fake_budgets, skew):
+    import packages.orchestration.context_builder as cb
+    from packages.providers import lmstudio_tokens
+    from packages.storage.repo import create_thread, append_messages_bulk
+
+    fake_budgets(C_eff=32768, R_out=1024, B_work=2000, core_cap=2000)
+    def no_proxy(*a, **k):
+        raise RuntimeError("offline")
+    monkeypatch.setattr(lmstudio_tokens, 'count_tokens_chat', no_proxy)
+    monkeypatch.setattr(cb.get_settings(), 'SUMMARIZE_INSTEAD_OF_TRIM', False)
+
+    th = create_thread(None)
+    append_messages_bulk(th.id, [
+        m for i in range(60)
+        for m in ({'role': 'user', 'content': f'u{i} ' + 'x' * 80}, {'role': 'assistant', 'content': f'a{i} ' + 'y' * 80})
+    ])
+    ref = await cb.assemble_context(th.id, 'lm:qwen/qwen3-14b', max_output_tokens=128, last_user_lang='en')
+    # the bisect estimate runs high (skew > 1) or low against the real counter
+    real_batch = cb.estimate_tokens_batch
+    monkeypatch.setattr(cb, 'estimate_tokens_batch', lambda texts: [int(n * skew) for n in real_batch(texts)])
+    out = await cb.assemble_context(th.id, 'lm:qwen/qwen3-14b', max_output_tokens=128, last_user_lang='en')
+    assert 0 < ref['stats']['l1_pairs_count'] < 60
+    assert out['stats']['l1_pairs_count'] == ref['stats']['l1_pairs_count']
+
+
+@pytest.mark.asyncio
+async def test_l1_stats_follow_compacted_l1(monkeypatch, fake_budgets):
+    import packages.orchestration.context_builder as cb
+    from packages.storage.repo import create_thread, append_messages_bulk
+
+    fake_budgets(C_eff=32768, R_out=1024, B_work=10000, core_cap=2000)
+    monkeypatch.setattr(cb.get_settings(), 'SUMMARIZE_INSTEAD_OF_TRIM', False)
+    real_compact = cb.compact_to_budget
+
+    async def compact_drops_oldest_pair(model_id, thread_id, lang, caps, blocks, meta):
+        out = await real_compact(model_id, thread_id, lang, caps, blocks, meta)
+        del blocks['l1'][:2]  # L1 trimmed after the cut was chosen
+        return out
+    monkeypatch.setattr(cb, 'compact_to_budget', compact_drops_oldest_pair)
+
+    th = create_thread(None)
+    ids = append_messages_bulk(th.id, [
+        m for i in range(8)
+        for m in ({'role': 'user', 'content': f'u{i}'}, {'role': 'assistant', 'content': f'a{i}'})
+    ])
+    out = await cb.assemble_context(th.id, 'lm:qwen/qwen3-14b', max_output_tokens=128, last_user_lang='en')
+    stats = out['stats']
+    assert stats['l1_pairs_count'] == len(out['messages']) // 2 == 7
+    assert stats['l1_order_preview'][0] == f"{ids[2]}->{ids[3]}"
+    assert stats['l1_order_preview'][-1] == f"{ids[14]}->{ids[15]}"
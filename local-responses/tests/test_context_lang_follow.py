@@ -5,35 +5,32 @@ import pytest
 from packages.orchestration.context_builder import assemble_context
 
 @pytest.mark.asyncio
-async def test_lang_follow_ru(monkeypatch):
-    async def fake_budgets(model_id, mot, core_tokens, core_cap, settings=None):
-        return {
-            'C_eff': 4096, 'R_out': 512, 'R_sys': 256, 'Safety': 256,
-            'B_total_in': 4096-512-256-256, 'B_work': 1000, 'core_sys_pad': 100,
-            'core_tokens': 0, 'core_cap': 500,
-        }
+async def test_lang_follow_ru(fake_budgets):
     import packages.orchestration.context_builder as cb
-    monkeypatch.setattr(cb, 'compute_budgets', fake_budgets)
+    fake_budgets()
 
     out = await assemble_context(thread_id='thread_dummy', model_id='lm:qwen/qwen3-14b', max_output_tokens=None, tool_results_text=None, tool_results_tokens=None, last_user_lang='ru')
     text = out['system_text']
     assert 'Следуй правилам' in text
     assert 'ПРОФИЛЬ (ЯДРО)' in text
     assert '---' in text
+    assert text.startswith(cb._SYS_SKELETON['ru'])
 
 @pytest.mark.asyncio
-async def test_lang_follow_en(monkeypatch):
-    async def fake_budgets(model_id, mot, core_tokens, core_cap, settings=None):
-        return {
-            'C_eff': 4096, 'R_out': 512, 'R_sys': 256, 'Safety': 256,
-            'B_total_in': 4096-512-256-256, 'B_work': 1000, 'core_sys_pad': 100,
-            'core_tokens': 0, 'core_cap': 500,
-        }
-    import packages.orchestration.context_builder as cb
-    monkeypatch.setattr(cb, 'compute_budgets', fake_budgets)
+async def test_lang_follow_en(fake_budgets):
+    fake_budgets()
 
     out = await assemble_context(thread_id='thread_dummy', model_id='lm:qwen/qwen3-14b', max_output_tokens=None, tool_results_text=None, tool_results_tokens=None, last_user_lang='en')
     text = out['system_text']
     assert 'Follow the rules' in text
     assert 'CORE PROFILE' in text
     assert '---' in text
+
+
+def test_i18n_lookup_fallbacks():
+    from packages.utils.i18n import STRINGS, pick_lang, t
+
+    assert pick_lang("RU", "en") == "ru" and pick_lang(None, None) == "en"
+    assert t("ru", "core_profile") == STRINGS["ru"]["core_profile"]
+    assert t("de", "core_profile") == STRINGS["en"]["core_profile"]  # unknown language -> en
+    assert t("ru", "no_such_key") == "NO_SUCH_KEY"
@@ -11,3 +11,14 @@ def test_cost_calculation_default_price() -> None:
     total_tokens = 1500
     cost = Decimal((total_tokens / 1000) * price).quantize(Decimal("0.000001"))
     assert cost == Decimal("0.750000")
+
+
+def test_cost_for_fixed_point() -> None:
+    from packages.core.pricing import cost_for, to_micros
+
+    assert to_micros(0.5) == 500_000
+    assert cost_for(1500, 0.5) == Decimal("0.750000")
+    assert str(cost_for(1500, 0.5)) == "0.750000"
+    assert cost_for(1, 0.0015) == Decimal("0.000002")  # 1.5 micros, half-up
+    assert cost_for(0, 2.0) == Decimal("0.000000")
+    assert cost_for(None, 2.0) == Decimal("0")
@@ -5,17 +5,15 @@ import pytest
 from packages.orchestration.context_builder import assemble_context
 
 @pytest.mark.asyncio
-async def test_current_user_only_mode(monkeypatch):
-    # Fake budgets to have small input capacity to trigger minimal context mode
-    async def fake_budgets(model_id, mot, core_tokens, core_cap, settings=None):
-        return {
-            'C_eff': 2048, 'R_out': 128, 'R_sys': 128, 'Safety': 128,
-            'B_total_in': 256, 'B_work': 64, 'core_sys_pad': 32,
-            'core_tokens': core_tokens, 'core_cap': core_cap,
-            'core_reserved': 64, 'effective_max_output_tokens': 128,
-        }
+async def test_current_user_only_mode(fake_budgets, monkeypatch):
     import packages.orchestration.context_builder as cb
-    monkeypatch.setattr(cb, 'compute_budgets', fake_budgets)
+
+    def no_memory(*a, **kw):
+        raise AssertionError("memory must not be read in current-user-only mode")
+    monkeypatch.setattr(cb, '_load_memory', no_memory)
+    # Fake budgets to have small input capacity to trigger minimal context mode
+    fake_budgets(C_eff=2048, R_out=128, R_sys=128, Safety=128, B_total_in=256, B_work=64, core_sys_pad=32,
+                 core_reserved=64, effective_max_output_tokens=128)
 
     huge_text = "X" * 10000
     out = await assemble_context(
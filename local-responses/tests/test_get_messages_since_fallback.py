@@ -1,18 +1,35 @@
 import pytest
 from packages.storage.repo import get_messages_since, session_scope, Message, create_thread
-import time
+from datetime import datetime, timedelta
+import uuid
 
 @pytest.mark.asyncio
-async def test_get_messages_since_fallback():
+async def test_get_messages_since_fallback(db_session):
     with session_scope() as s:
         th = create_thread(title=None)
         thread_id = th.id
-        now = int(time.time())
-        m1 = Message(thread_id=thread_id, role="user", content="u1", created_at=now)
-        m2 = Message(thread_id=thread_id, role="assistant", content="a1", created_at=now+1)
+        now = datetime.utcnow()
+        m1 = Message(id=str(uuid.uuid4()), thread_id=thread_id, role="user", content="u1", created_at=now)
+        m2 = Message(id=str(uuid.uuid4()), thread_id=thread_id, role="assistant", content="a1", created_at=now + timedelta(seconds=1))
         s.add_all([m1, m2])
         s.commit()
     # last_id несуществующий
     msgs = get_messages_since(thread_id, last_id="nonexistent")
     # Должны вернуть все user/assistant
     assert [m.content for m in msgs] == ["u1", "a1"]
+
+
+def test_get_messages_since_anchor_ties_break_on_id(db_session):
+    th = create_thread(title=None)
+    ts = datetime.utcnow()
+    a, b, c, d = (f"{th.id}-{k}" for k in "abcd")  # same created_at for a/b: id breaks the tie
+    with session_scope() as s:
+        s.add_all([
+            Message(id=a, thread_id=th.id, role="user", content="a", created_at=ts),
+            Message(id=b, thread_id=th.id, role="assistant", content="b", created_at=ts),
+            Message(id=c, thread_id=th.id, role="system", content="c", created_at=ts + timedelta(seconds=1)),
+            Message(id=d, thread_id=th.id, role="user", content="d", created_at=ts + timedelta(seconds=2)),
+        ])
+    assert [m.id for m in get_messages_since(th.id, a)] == [b, d]
+    assert [m.id for m in get_messages_since(th.id, d)] == []
+    assert [m.id for m in get_messages_since(th.id, None)] == [a, b, d]
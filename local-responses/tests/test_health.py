@@ -1,14 +1,9 @@
 # tests/test_health.py
 from __future__ import annotations
 
-from httpx import AsyncClient, ASGITransport
-from apps.api.main import app
 
-
-async def test_health() -> None:
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        resp = await ac.get("/health")
+async def test_health(api_client) -> None:
+    resp = await api_client.get("/health")
     assert resp.status_code == 200
     data = resp.json()
     assert data["status"] == "ok"
@@ -1,7 +1,8 @@
 import pytest
 from packages.orchestration.context_builder import assemble_context
 from packages.storage.repo import session_scope, Message, create_thread
-import time
+import uuid
+from datetime import datetime, timedelta
 
 @pytest.mark.asyncio
 async def test_l1_ordering():
@@ -9,12 +10,12 @@ async def test_l1_ordering():
     with session_scope() as s:
         th = create_thread(title=None)
         thread_id = th.id
-        now = int(time.time())
-        m1 = Message(thread_id=thread_id, role="user", content="u1", created_at=now)
-        m2 = Message(thread_id=thread_id, role="assistant", content="a1", created_at=now+1)
-        m3 = Message(thread_id=thread_id, role="user", content="u2", created_at=now+2)
-        m4 = Message(thread_id=thread_id, role="assistant", content="a2", created_at=now+3)
-        s.add_all([m1, m2, m3, m4])
+        now = datetime.utcnow()
+        # uuid ids are random: order must come from (created_at, id), not from id alone
+        s.add_all([
+            Message(id=str(uuid.uuid4()), thread_id=thread_id, role=role, content=text, created_at=now + timedelta(seconds=i))
+            for i, (role, text) in enumerate([("user", "u1"), ("assistant", "a1"), ("user", "u2"), ("assistant", "a2")])
+        ])
         s.commit()
     assembled = await assemble_context(thread_id, 'lm:qwen/qwen3-14b', max_output_tokens=128, tool_results_text=None, tool_results_tokens=None, last_user_lang='en', current_user_text="Q?")
     msgs = assembled["messages"]
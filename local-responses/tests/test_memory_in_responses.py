@@ -1,21 +1,11 @@
 from __future__ import annotations
 
-import importlib
-import os
 import pytest
-from httpx import ASGITransport, AsyncClient
 
 @pytest.mark.asyncio
-async def test_memory_metadata_in_responses(monkeypatch):
-    # ensure app loaded
-    import apps.api.main as api_main
-    importlib.reload(api_main)
-    app = api_main.app
-
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        payload = {"model": "lm:qwen/qwen3-14b", "input": "hello", "max_output_tokens": 64}
-        r = await ac.post("/responses", json=payload)
+async def test_memory_metadata_in_responses(monkeypatch, api_client):
+    payload = {"model": "lm:qwen/qwen3-14b", "input": "hello", "max_output_tokens": 64}
+    r = await api_client.post("/responses", json=payload)
     assert r.status_code in (200, 424, 502)
     if r.status_code == 200:
         d = r.json()
@@ -29,3 +19,14 @@ async def test_tools_tokens_reduce_l1_cap(monkeypatch):
     caps1 = compute_level_caps(1000, tools_tokens=0)
     caps2 = compute_level_caps(1000, tools_tokens=500)
     assert caps2['l1'] <= caps1['l1']
+
+
+def test_settings_frozen_tracks_instance(settings_env):
+    from packages.core import settings as s
+
+    hot = s.get_settings_frozen()
+    assert hot is s.get_settings_frozen()
+    assert hot.mem_l1_share == s.get_settings().mem_l1_share
+    settings_env(MEM_L1_SHARE="0.5")
+    assert s.get_settings_frozen().mem_l1_share == 0.5
+
@@ -3,17 +3,22 @@ from __future__ import annotations
 import asyncio
 import pytest
 
-from packages.storage.repo import create_thread, append_message
+from packages.storage.repo import create_thread, append_message, append_messages_bulk
 from packages.orchestration.memory_manager import compute_level_caps, build_l1_pairs, update_memory
 
 
 @pytest.mark.asyncio
 async def test_memory_levels_promotions_and_caps(monkeypatch):
     th = create_thread(None)
-    # generate a long series: user/assistant pairs
-    for i in range(40):
-        append_message(th.id, 'user', f'user says {i} ' + ('x'*100))
-        append_message(th.id, 'assistant', f'assistant replies {i} ' + ('y'*200))
+    # generate a long series: user/assistant pairs (one INSERT, one commit)
+    append_messages_bulk(th.id, [
+        row
+        for i in range(40)
+        for row in (
+            {'role': 'user', 'content': f'user says {i} ' + ('x'*100)},
+            {'role': 'assistant', 'content': f'assistant replies {i} ' + ('y'*200)},
+        )
+    ])
 
     budget = {'B_work': 4096}
     caps = compute_level_caps(budget['B_work'], tools_tokens=0)
@@ -27,7 +32,7 @@ async def test_memory_levels_promotions_and_caps(monkeypatch):
     from packages.core import settings as s
     s.get_settings.cache_clear()
     from packages.core.settings import AppSettings
-    AppSettings.mem_free_threshold = 0.99  # type: ignore
+    monkeypatch.setattr(AppSettings, "mem_free_threshold", 0.99, raising=False)
 
     mem2 = await update_memory(th.id, budget, tool_results_tokens=0, now=0)
     # expect some actions indicating promotions or trims (may be empty if content small)
@@ -43,3 +48,148 @@ async def test_memory_levels_promotions_and_caps(monkeypatch):
     u_tok = len(pairs[0][0])//4 + (1 if len(pairs[0][0])%4 else 0)
     a_tok = len(pairs[0][1])//4 + (1 if len(pairs[0][1])%4 else 0)
     assert u_tok <= st.cap_tok_user and a_tok <= st.cap_tok_assistant
+
+
+def test_trim_l3_drops_oldest_until_under_cap(db_session):
+    from packages.storage.repo import insert_l3, trim_l3_if_over, get_l3_for_thread
+    th = create_thread(None)
+    for toks in (10, 20, 30, 40):
+        insert_l3(th.id, start_l2_id=1, end_l2_id=1, text=f"l3 {toks}", tokens=toks)
+    removed = trim_l3_if_over(th.id, 75)
+    assert removed == 2
+    assert [r.tokens for r in get_l3_for_thread(th.id)] == [30, 40]
+    assert trim_l3_if_over(th.id, 75) == 0
+
+
+@pytest.mark.asyncio
+async def test_ensure_l2_for_pairs_skips_covered_and_missing(monkeypatch):
+    from packages.orchestration import summarizer
+    from packages.storage.repo import ensure_l2_for_pairs, get_l2_for_thread
+
+    async def fake_pair(u, a, lang):
+        return f"{u} -> {a}"
+    monkeypatch.setattr(summarizer, 'summarize_pair_to_l2', fake_pair)
+
+    th = create_thread(None)
+    u1 = append_message(th.id, 'user', 'q1')
+    a1 = append_message(th.id, 'assistant', 'r1')
+    u2 = append_message(th.id, 'user', 'q2')
+    a2 = append_message(th.id, 'assistant', 'r2')
+    pairs = [(u1.id, a1.id), (u2.id, a2.id), ('missing_u', 'missing_a')]
+
+    assert await ensure_l2_for_pairs(th.id, pairs, 'en', now=1) == 2
+    assert await ensure_l2_for_pairs(th.id, pairs, 'en', now=2) == 0
+    assert [r.text for r in get_l2_for_thread(th.id)] == ['q1 -> r1', 'q2 -> r2']
+
+
+@pytest.mark.asyncio
+async def test_promote_l2_to_l3_awaits_summarizer(monkeypatch):
+    from packages.orchestration import summarizer
+    from packages.storage.repo import insert_l2_summary, promote_l2_to_l3, get_l2_for_thread, get_l3_for_thread
+
+    async def fake_block(texts, lang='ru', max_tokens=None):
+        return 'L3: ' + ' / '.join(texts)
+    monkeypatch.setattr(summarizer, 'summarize_l2_block_to_l3', fake_block)
+
+    th = create_thread(None)
+    ids = [insert_l2_summary(th.id, 'u', 'a', f'l2 {i}', now=1).id for i in range(3)]
+    assert await promote_l2_to_l3(th.id, ids[:2], 'en', now=2) == 2
+    assert [r.text for r in get_l2_for_thread(th.id)] == ['l2 2']
+    l3 = get_l3_for_thread(th.id)
+    assert [(r.text, r.start_l2_id, r.end_l2_id) for r in l3] == [('L3: l2 0 / l2 1', ids[0], ids[1])]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_ensure_l2_for_pairs_writes_once(monkeypatch):
+    from packages.orchestration import summarizer
+    from packages.storage.repo import ensure_l2_for_pairs, get_l2_for_thread
+
+    async def fake_pair(u, a, lang):
+        await asyncio.sleep(0)
+        return f"{u} -> {a}"
+    monkeypatch.setattr(summarizer, 'summarize_pair_to_l2', fake_pair)
+
+    th = create_thread(None)
+    u1 = append_message(th.id, 'user', 'q1')
+    a1 = append_message(th.id, 'assistant', 'r1')
+    pairs = [(u1.id, a1.id)]
+    # every call passes the pre-check; the per-thread write lock lets only one insert
+    created = await asyncio.gather(*(ensure_l2_for_pairs(th.id, pairs, 'en', now=1) for _ in range(4)))
+    assert sum(created) == 1
+    assert len(get_l2_for_thread(th.id)) == 1
+
+
+def test_bulk_delete_helpers():
+    from packages.storage.repo import insert_l2_summary, insert_l3, delete_l2_batch, evict_l3_oldest, get_l2_for_thread, get_l3_for_thread
+
+    th = create_thread(None)
+    ids = [insert_l2_summary(th.id, 'u', 'a', f'l2 {i}', now=1).id for i in range(3)]
+    assert delete_l2_batch(ids[:2] + [10**9]) == 2
+    assert [r.id for r in get_l2_for_thread(th.id)] == ids[2:]
+
+    for i in range(4):
+        insert_l3(th.id, start_l2_id=i, end_l2_id=i, text=f'l3 {i}', tokens=1)
+    assert evict_l3_oldest(th.id, count=3) == 3
+    assert [r.text for r in get_l3_for_thread(th.id)] == ['l3 3']
+
+
+def test_bulk_summary_inserts_keep_order(db_session):
+    from packages.storage.repo import insert_l2_summaries_bulk, insert_l3_summaries_bulk, get_l2_for_thread, get_l3_for_thread
+
+    th = create_thread(None)
+    l2s = insert_l2_summaries_bulk(th.id, [{'start_msg_id': f'u{i}', 'end_msg_id': f'a{i}', 'text': f'l2 {i}' * (i + 1), 'now': 1} for i in range(5)])
+    assert [r.start_message_id for r in l2s] == [f'u{i}' for i in range(5)]
+    assert [r.id for r in get_l2_for_thread(th.id)] == [r.id for r in l2s]
+    assert l2s[4].tokens > l2s[0].tokens
+
+    l3s = insert_l3_summaries_bulk(th.id, [{'l2_ids': [l2s[1].id, l2s[0].id], 'text': 'b0'}, {'l2_ids': [], 'text': 'skip'}, {'l2_ids': [l2s[2].id], 'text': 'b1'}])
+    assert [(r.start_l2_id, r.end_l2_id) for r in l3s] == [(l2s[0].id, l2s[1].id), (l2s[2].id, l2s[2].id)]
+    assert [r.text for r in get_l3_for_thread(th.id)] == ['b0', 'b1']
+    assert insert_l2_summaries_bulk(th.id, []) == []
+
+
+@pytest.mark.asyncio
+async def test_sync_wrappers_run_on_background_loop(monkeypatch):
+    from packages.orchestration import summarizer
+    from packages.storage.repo import ensure_l2_for_pairs_sync, get_l2_for_thread
+
+    async def fake_pair(u, a, lang):
+        return f"{u} -> {a}"
+    monkeypatch.setattr(summarizer, 'summarize_pair_to_l2', fake_pair)
+
+    th = create_thread(None)
+    u1 = append_message(th.id, 'user', 'q1')
+    a1 = append_message(th.id, 'assistant', 'r1')
+    # on the loop thread blocking would stall the loop: the caller is told to await instead
+    with pytest.raises(RuntimeError, match="await ensure_l2_for_pairs"):
+        ensure_l2_for_pairs_sync(th.id, [(u1.id, a1.id)], 'en', 1)
+    # plain sync code (a worker thread) runs on the background loop
+    assert await asyncio.to_thread(ensure_l2_for_pairs_sync, th.id, [(u1.id, a1.id)], 'en', 1) == 1
+    assert await asyncio.to_thread(ensure_l2_for_pairs_sync, th.id, [(u1.id, a1.id)], 'en', 2) == 0
+    assert len(get_l2_for_thread(th.id)) == 1
+
+
+@pytest.mark.asyncio
+async def test_promote_l2_to_l3_skips_rows_removed_meanwhile(monkeypatch):
+    from packages.orchestration import summarizer
+    from packages.storage.repo import insert_l2_summary, promote_l2_to_l3, delete_l2_batch, get_l3_for_thread
+
+    th = create_thread(None)
+    ids = [insert_l2_summary(th.id, 'u', 'a', f'l2 {i}', now=1).id for i in range(3)]
+
+    async def racing_block(texts, lang='ru', max_tokens=None):
+        delete_l2_batch([ids[0]])  # another writer drops one row while the LLM runs
+        return 'L3'
+    monkeypatch.setattr(summarizer, 'summarize_l2_block_to_l3', racing_block)
+
+    assert await promote_l2_to_l3(th.id, ids, 'en', now=2) == 2
+    assert [(r.start_l2_id, r.end_l2_id) for r in get_l3_for_thread(th.id)] == [(ids[1], ids[2])]
+
+
+def test_build_l1_pairs_order_and_unpaired():
+    from types import SimpleNamespace as M
+    msgs = [M(role='assistant', content='orphan'), M(role='user', content='u1'), M(role='assistant', content='a1'),
+            M(role='user', content='dangling'), M(role='user', content='u2'), M(role='assistant', content=None)]
+    pairs, toks = build_l1_pairs(msgs)
+    assert pairs == [('u1', 'a1'), ('u2', '')]
+    assert toks == 3
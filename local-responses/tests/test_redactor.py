@@ -0,0 +1,17 @@
+# tests/test_redactor.py
+from __future__ import annotations
+
+from packages.orchestration import redactor
+
+
+def test_redact_fragment_caches_only_short_texts() -> None:
+    redactor._redact_cached.cache_clear()
+    short = "a<think>x</think>b"
+    long = "<think>" + "r" * 10_000 + "</think>" + "z" * 10_000
+    plain = "q" * 10_000
+    assert redactor.redact_fragment(short) == "ab"
+    assert redactor.redact_fragment(long) == "z" * 10_000
+    assert redactor.redact_fragment(plain) is plain
+    # only the short fragment with a closing tag is held by the cache
+    assert redactor._redact_cached.cache_info().currsize == 1
+    redactor._redact_cached.cache_clear()
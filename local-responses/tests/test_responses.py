@@ -1,45 +1,27 @@
 # tests/test_responses.py
 from __future__ import annotations
 
-import os
-import importlib
-
 import pytest
-import respx
-from httpx import Response, AsyncClient, ASGITransport
 
 
 @pytest.mark.asyncio
-@respx.mock
-async def test_responses_lmstudio_success(async_client_factory=None) -> None:
-    base_url = os.environ.get("LMSTUDIO_BASE_URL", "http://127.0.0.1:1234")
-    os.environ["LMSTUDIO_BASE_URL"] = base_url
-
-    # Reset cached settings and reload app to pick up env
-    from packages.core import settings as settings_module
-    settings_module.get_settings.cache_clear()
-    import apps.api.main as api_main
-    importlib.reload(api_main)
-    app = api_main.app
+async def test_responses_lmstudio_success(api_client, app_settings, lmstudio_mock) -> None:
+    base_url = str(app_settings.lmstudio_base_url)
 
     # Mock LM Studio endpoint
-    route = respx.post(f"{base_url.rstrip('/')}/v1/chat/completions").mock(
-        return_value=Response(200, json={
-            "choices": [{"message": {"content": "Привет!"}}],
-            "usage": {"input_tokens": 10, "output_tokens": 2, "total_tokens": 12},
-        })
-    )
-
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        payload = {
-            "model": "lm:qwen/qwen3-14b",
-            "input": "Скажи привет одному предложению",
-            "system": "Ты лаконичный ассистент.",
-            "temperature": 0.3,
-            "max_output_tokens": 128,
-        }
-        resp = await ac.post("/responses", json=payload)
+    route = lmstudio_mock(base_url, json={
+        "choices": [{"message": {"content": "Привет!"}}],
+        "usage": {"input_tokens": 10, "output_tokens": 2, "total_tokens": 12},
+    })
+
+    payload = {
+        "model": "lm:qwen/qwen3-14b",
+        "input": "Скажи привет одному предложению",
+        "system": "Ты лаконичный ассистент.",
+        "temperature": 0.3,
+        "max_output_tokens": 128,
+    }
+    resp = await api_client.post("/responses", json=payload)
 
     assert route.called
     assert resp.status_code == 200
@@ -51,18 +33,28 @@ async def test_responses_lmstudio_success(async_client_factory=None) -> None:
 
 
 @pytest.mark.asyncio
-async def test_responses_unsupported_model_prefix() -> None:
-    # Ensure app is loaded (no need for LM env here)
-    import apps.api.main as api_main
-    importlib.reload(api_main)
-    app = api_main.app
-
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        payload = {
-            "model": "gpt-4o-mini",
-            "input": "hi",
-        }
-        resp = await ac.post("/responses", json=payload)
+async def test_responses_unsupported_model_prefix(api_client) -> None:
+    payload = {
+        "model": "gpt-4o-mini",
+        "input": "hi",
+    }
+    resp = await api_client.post("/responses", json=payload)
     # Expect error due to unsupported provider prefix
     assert resp.status_code in (424, 502, 400)
+
+
+@pytest.mark.asyncio
+async def test_responses_body_rejects_nan(api_client, app_settings, lmstudio_mock, monkeypatch) -> None:
+    import apps.api.main as main
+
+    lmstudio_mock(str(app_settings.lmstudio_base_url), json={
+        "choices": [{"message": {"content": "ok"}}],
+        "usage": {"input_tokens": 1, "output_tokens": 1, "total_tokens": 2},
+    })
+
+    async def nan_memory(*args, **kwargs):
+        return {"free_pct": {"l1": float("nan")}}
+    monkeypatch.setattr(main, "update_memory", nan_memory)
+    # strict JSON on the wire: NaN is an error, never a bare NaN token or a silent null
+    with pytest.raises(ValueError, match="JSON compliant"):
+        await api_client.post("/responses", json={"model": "lm:qwen/qwen3-14b", "input": "hi"})
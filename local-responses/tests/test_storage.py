@@ -5,7 +5,7 @@ from packages.storage.repo import create_thread, append_message, get_thread, ses
 from packages.storage.models import Thread, Message, Response
 
 
-def test_thread_create_and_cascade() -> None:
+def test_thread_create_and_cascade(db_session) -> None:
     th = create_thread("Title")
     assert th.id
 
@@ -24,3 +24,148 @@ def test_thread_create_and_cascade() -> None:
         s.commit()
         msgs = s.query(Message).filter(Message.thread_id == th.id).all()
         assert len(msgs) == 0
+
+
+def test_append_messages_bulk_keeps_order_and_skips_length_retry(db_session) -> None:
+    from packages.storage.repo import append_messages_bulk
+
+    th = create_thread(None)
+    ids = append_messages_bulk(th.id, [
+        {"role": "user", "content": "q"},
+        {"role": "assistant", "content": "cut", "finish_reason": "length", "attempt": 1},
+        {"role": "assistant", "content": "a", "tokens": {"input_tokens": 3, "output_tokens": 2}},
+    ])
+    assert len(ids) == 2
+    with session_scope() as s:
+        msgs = s.query(Message).filter(Message.thread_id == th.id).order_by(Message.created_at.asc()).all()
+        assert [m.id for m in msgs] == ids
+        assert [m.content for m in msgs] == ["q", "a"]
+        assert msgs[1].total_tokens == 5
+
+
+def test_engine_kwargs_per_dialect() -> None:
+    from packages.core.settings import AppSettings
+    from packages.storage.repo import _engine_kwargs
+
+    mem = _engine_kwargs(AppSettings(db_url="sqlite://"))
+    assert mem["connect_args"] == {"check_same_thread": False} and "poolclass" in mem
+    assert "poolclass" not in _engine_kwargs(AppSettings(db_url="sqlite:///data/app.db"))
+    pg = _engine_kwargs(AppSettings(db_url="postgresql://u@h/db", DB_POOL_SIZE=3))
+    assert pg["pool_size"] == 3 and pg["pool_pre_ping"] is True and pg["pool_recycle"] == 1800
+
+
+def test_message_caches_sanitized_tokens(db_session) -> None:
+    th = create_thread(None)
+    m = append_message(th.id, "assistant", "<think>" + "r" * 400 + "</think>abcdefgh")
+    with session_scope() as s:
+        row = s.get(Message, m.id)
+        assert row.sanitized_tokens == 2  # only the visible 8 chars count
+
+
+def test_sqlite_connections_use_wal() -> None:
+    from packages.storage.repo import engine
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+
+
+def test_request_session_scope_is_shared_on_its_thread_only() -> None:
+    import threading
+    from packages.storage.repo import request_session_scope
+
+    with request_session_scope() as req_s:
+        th = create_thread(None)
+        with session_scope() as s:
+            assert s is req_s
+            assert s.get(Thread, th.id) is th  # same identity map, no extra transaction
+        seen = []
+
+        def worker() -> None:
+            with session_scope() as ws:
+                seen.append(ws)
+
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        assert seen[0] is not req_s
+    # committed once at the end of the request scope
+    assert get_thread(th.id) is not None
+
+
+def test_l1_history_cut_and_tail_in_sql(db_session) -> None:
+    from packages.storage.repo import append_messages_bulk, get_thread_messages_for_l1
+
+    th = create_thread(None)
+    ids = append_messages_bulk(th.id, [
+        {"role": "user", "content": "u1"},
+        {"role": "assistant", "content": "<think>x</think>a1"},
+        {"role": "tool", "content": "t"},
+        {"role": "user", "content": "u2"},
+        {"role": "assistant", "content": "a2"},
+    ])
+    assert [m.content for m in get_thread_messages_for_l1(th.id)] == ["u1", "a1", "u2", "a2"]
+    assert [m.content for m in get_thread_messages_for_l1(th.id, exclude_message_id=ids[3])] == ["u1", "a1"]
+    assert [m.content for m in get_thread_messages_for_l1(th.id, max_items=2)] == ["u2", "a2"]
+    assert [m.content for m in get_thread_messages_for_l1(th.id, exclude_message_id="nope")][-1] == "a2"
+    with session_scope() as s:
+        assert s.get(Message, ids[1]).content.startswith("<think>")  # stored row untouched
+
+
+def test_db_session_fixture_keeps_writes_uncommitted(db_session) -> None:
+    from sqlalchemy import select
+    from packages.storage.repo import engine
+
+    th = create_thread(None)
+    with session_scope() as s:
+        assert s is db_session
+    with engine.connect() as other:  # separate connection: nothing committed yet
+        assert other.execute(select(Thread.id).where(Thread.id == th.id)).first() is None
+
+
+async def test_writer_queue_failure_reaches_only_the_failing_row(monkeypatch) -> None:
+    import asyncio
+    from sqlalchemy.exc import IntegrityError
+    from packages.storage import repo
+
+    batches = []
+    add_all = repo._add_all
+    monkeypatch.setattr(repo, "_add_all", lambda objs: (batches.append(len(objs)), add_all(objs)))
+    th = create_thread(None)
+    writer = repo._WriterQueue()
+    first = await writer.submit(repo._build_message(th.id, "user", "q", None, None, None))
+    ok = repo._build_message(th.id, "assistant", "a", None, None, None)
+    dup = repo._build_message(th.id, "assistant", "dup", None, None, None)
+    dup.id = first.id  # primary key clash fails the whole batch
+    res_ok, res_dup = await asyncio.gather(writer.submit(ok), writer.submit(dup), return_exceptions=True)
+    assert batches == [1, 2, 1, 1]  # one batch of two, then each row on its own
+    assert res_ok is ok
+    assert isinstance(res_dup, IntegrityError)
+    with session_scope() as s:
+        assert s.get(Message, ok.id).content == "a"
+        assert s.query(Message).filter(Message.thread_id == th.id).count() == 2
+
+
+async def test_shared_db_session_only_on_db_read_routes(api_client) -> None:
+    from sqlalchemy import event
+    from apps.api.main import app, shared_db_session
+    from packages.storage.repo import engine
+
+    shared = {r.path for r in app.routes if any(d.dependency is shared_db_session for d in getattr(r, "dependencies", []))}
+    # no LM Studio / streaming handler holds a request-long session
+    assert shared == {"/profile", "/config", "/threads/{thread_id}", "/threads/{thread_id}/messages", "/threads/{thread_id}/memory"}
+
+    th = create_thread(None)
+    append_message(th.id, "user", "hi")
+    append_message(th.id, "assistant", "hello")
+    begins = []
+
+    def on_begin(conn) -> None:
+        begins.append(conn)
+    event.listen(engine, "begin", on_begin)
+    try:
+        r = await api_client.get(f"/threads/{th.id}/messages")
+    finally:
+        event.remove(engine, "begin", on_begin)
+    assert r.status_code == 200 and len(r.json()["messages"]) == 2
+    assert len(begins) == 1  # every session_scope() in the handler joined one transaction
@@ -2,86 +2,169 @@
 from __future__ import annotations
 
 import asyncio
-import json
-import importlib
-import os
+import re
+from typing import Any, AsyncIterator
 
 import pytest
-import respx
-from httpx import Response, AsyncClient, ASGITransport
+from httpx import Response, AsyncClient
 
+from packages.utils.tokens import json_loads as _loads
 
-async def collect_sse_bytes(ac: AsyncClient, url: str, body: dict | None = None, timeout: float = 5.0):
-    chunks: list[bytes] = []
+_EV_PREFIX = b"event: "
+_DATA_PREFIX = b"data: "
+_EV_LEN, _DATA_LEN = len(_EV_PREFIX), len(_DATA_PREFIX)
+_BLOCK_SEP = re.compile(rb"\r?\n\r?\n")
+
+# upstream (LM Studio) stream bodies, built once at import
+_DONE = b"data: [DONE]\n\n"
+_X_DELTA = b"data: {\"choices\":[{\"delta\":{\"content\":\"x\"}}]}\n\n"
+_STREAM_BODY = (
+    b"data: {\"choices\":[{\"delta\":{\"content\":\"\\u041f\\u0440\\u0438\\u0432\"}}]}\n\n"
+    b"data: {\"choices\":[{\"delta\":{\"content\":\"\\u0435\\u0442!\"}}]}\n\n"
+    + _DONE
+)
+
+
+async def collect_sse_bytes(
+    ac: AsyncClient,
+    url: str,
+    body: dict | None = None,
+    timeout: float = 5.0,
+) -> bytes:
+    """Read the whole SSE body into one bytearray.
+
+    ASGITransport hands over the body only after the app has finished, so there
+    is nothing to gain from stopping early here."""
+    buf = bytearray()
     async with ac.stream("POST", url, json=body) as resp:
         assert resp.status_code == 200
         assert resp.headers.get("content-type", "").startswith("text/event-stream")
-        async for b in resp.aiter_bytes():
-            chunks.append(b)
-            if len(chunks) > 20000:
-                break
-    return b"".join(chunks)
-
-
-def parse_events(raw: bytes):
-    text = raw.decode("utf-8", errors="ignore")
-    events: list[tuple[str, dict]] = []
-    for block in text.split("\n\n"):
-        if not block.strip():
-            continue
-        lines = block.splitlines()
-        ev = None
-        data = ""
-        for ln in lines:
-            if ln.startswith("event: "):
-                ev = ln[len("event: "):]
-            elif ln.startswith("data: "):
-                data = ln[len("data: "):]
-        if ev:
-            try:
-                events.append((ev, json.loads(data)))
-            except Exception:
-                pass
+        # the app sends identity-coded SSE: raw chunks skip httpx's content-decoding layer
+        async for b in resp.aiter_raw():
+            buf.extend(b)
+    return bytes(buf)
+
+
+def _parse_block(raw: bytes | bytearray, pos: int, end: int) -> tuple[str, Any] | None:
+    """(event, data) of the block raw[pos:end]: find() line ends, prefix checks in place,
+    only the event name and data value are sliced out. None for comments/bad JSON."""
+    ev: str | None = None
+    data = b""
+    while pos < end:
+        nl = raw.find(b"\n", pos, end)
+        if nl < 0:
+            nl = end
+        stop = nl - 1 if nl > pos and raw[nl - 1] == 0x0D else nl  # \r\n
+        if raw.startswith(_EV_PREFIX, pos, stop):
+            ev = raw[pos + _EV_LEN:stop].decode("utf-8", errors="ignore")
+        elif raw.startswith(_DATA_PREFIX, pos, stop):
+            data = raw[pos + _DATA_LEN:stop]
+        pos = nl + 1
+    if not ev:
+        return None
+    try:
+        return ev, _loads(data)
+    except ValueError:
+        return None
+
+
+def parse_events(raw: bytes) -> list[tuple[str, Any]]:
+    events: list[tuple[str, Any]] = []
+    pos = 0
+    for m in _BLOCK_SEP.finditer(raw):
+        if (item := _parse_block(raw, pos, m.start())) is not None:
+            events.append(item)
+        pos = m.end()
+    if (item := _parse_block(raw, pos, len(raw))) is not None:  # last block without a trailing blank line
+        events.append(item)
     return events
 
 
+async def iter_events(ac: AsyncClient, url: str, body: dict | None = None) -> AsyncIterator[tuple[str, Any]]:
+    """Yield (event, data) per complete block; only the unfinished tail stays buffered.
+
+    Under ASGITransport the whole body arrives at once, so this checks the
+    incremental parser (see the chunk-boundary test), not streaming latency."""
+    buf = bytearray()
+    async with ac.stream("POST", url, json=body) as resp:
+        assert resp.status_code == 200
+        assert resp.headers.get("content-type", "").startswith("text/event-stream")
+        async for chunk in resp.aiter_raw():
+            buf.extend(chunk)
+            # spans first: the bytearray can't be resized while a regex iterator holds it
+            spans = [(m.start(), m.end()) for m in _BLOCK_SEP.finditer(buf)]
+            pos = 0
+            for start, end in spans:
+                if (item := _parse_block(buf, pos, start)) is not None:
+                    yield item
+                pos = end
+            if pos:
+                del buf[:pos]
+    if (item := _parse_block(buf, 0, len(buf))) is not None:
+        yield item
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        pytest.param(b"", [], id="empty"),
+        pytest.param(b"\n\n\n", [], id="blank-lines-only"),
+        pytest.param(b'event: meta\ndata: {"a":1}\n\n', [("meta", {"a": 1})], id="one-block"),
+        pytest.param(b'event: done\ndata: {}', [("done", {})], id="no-trailing-blank"),
+        pytest.param(b'event: delta\r\ndata: {"text":"x"}\r\n\r\n', [("delta", {"text": "x"})], id="crlf"),
+        pytest.param(b'event: delta\ndata: {"text":"\xd0\x9f\xd1\x80"}\n\n', [("delta", {"text": "Пр"})], id="utf8-raw"),
+        pytest.param(b'event: delta\ndata: {"text":"\\u041f"}\n\n', [("delta", {"text": "П"})], id="utf8-escaped"),
+        pytest.param(b'event: delta\ndata: {"text":""}\n\n', [("delta", {"text": ""})], id="empty-delta"),
+        pytest.param(b': ping\n\nevent: usage\ndata: {"n":1}\n\n', [("usage", {"n": 1})], id="comment-before"),
+        pytest.param(b'event: ping\ndata: {"ts":"t"}\n\nevent: done\ndata: {}\n\n', [("ping", {"ts": "t"}), ("done", {})], id="ping-then-done"),
+        pytest.param(b'event: bad\ndata: {x\n\nevent: ok\ndata: 1\n\n', [("ok", 1)], id="bad-json-skipped"),
+        pytest.param(b'data: {"orphan":1}\n\n', [], id="data-without-event"),
+        pytest.param(b'event: e\ndata: 1\ndata: 2\n\n', [("e", 2)], id="last-data-line-wins"),
+    ],
+)
+def test_parse_events_shapes(raw: bytes, expected: list) -> None:
+    assert parse_events(raw) == expected
+
+
 @pytest.mark.asyncio
-@respx.mock
-async def test_stream_basic_order_and_text() -> None:
-    # Reload app to pick env/.env
-    from packages.core import settings as settings_module
-    settings_module.get_settings.cache_clear()
-    import apps.api.main as api_main
-    importlib.reload(api_main)
-    app = api_main.app
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+async def test_iter_events_across_chunk_boundaries(size: int) -> None:
+    import httpx
 
-    base_url = str(api_main.settings.lmstudio_base_url or os.environ.get("LMSTUDIO_BASE_URL", "http://192.168.0.111:1234"))
+    raw = b'event: a\r\ndata: {"x":"\xd0\x9f"}\r\n\r\n: c\n\nevent: b\ndata: 2\n\nevent: c\ndata: 3'
 
-    # Mock streaming from LM Studio
-    stream_body = (
-        b"data: {\"choices\":[{\"delta\":{\"content\":\"\\u041f\\u0440\\u0438\\u0432\"}}]}\n\n"
-        b"data: {\"choices\":[{\"delta\":{\"content\":\"\\u0435\\u0442!\"}}]}\n\n"
-        b"data: [DONE]\n\n"
-    )
-    route = respx.post(f"{base_url.rstrip('/')}/v1/chat/completions").mock(
-        return_value=Response(200, content=stream_body)
-    )
+    async def chunks():
+        for i in range(0, len(raw), size):
+            yield raw[i:i + size]
 
-    transport = ASGITransport(app=app)
+    transport = httpx.MockTransport(lambda request: Response(200, headers={"content-type": "text/event-stream"}, content=chunks()))
     async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        payload = {
-            "model": "lm:qwen/qwen3-14b",
-            "input": "Скажи привет одному предложению",
-            "system": "Ты лаконичный ассистент.",
-            "temperature": 0.3,
-            "max_output_tokens": 64,
-        }
-        raw = await collect_sse_bytes(ac, "/responses?stream=true", body=payload)
+        got = [item async for item in iter_events(ac, "/sse")]
+    assert got == parse_events(raw) == [("a", {"x": "П"}), ("b", 2), ("c", 3)]
+
+
+@pytest.mark.asyncio
+async def test_stream_basic_order_and_text(api_app, api_client, lmstudio_mock) -> None:
+    _, st = api_app
+    base_url = str(st.lmstudio_base_url)
+
+    # Mock streaming from LM Studio
+    route = lmstudio_mock(base_url, _STREAM_BODY)
+
+    payload = {
+        "model": "lm:qwen/qwen3-14b",
+        "input": "Скажи привет одному предложению",
+        "system": "Ты лаконичный ассистент.",
+        "temperature": 0.3,
+        "max_output_tokens": 64,
+    }
+    events = [item async for item in iter_events(api_client, "/responses?stream=true", body=payload)]
 
     assert route.called
-    events = parse_events(raw)
     names = [n for n, _ in events]
-    assert names[0] == "meta"
+    # the user turn is echoed before the response meta
+    assert names[:2] == ["message", "meta"]
+    assert events[0][1]["role"] == "user" and events[0][1]["content"] == payload["input"]
     assert "delta" in names[1:-2]
     assert names[-2] == "usage"
     assert names[-1] == "done"
@@ -90,37 +173,84 @@ async def test_stream_basic_order_and_text() -> None:
     assert text == "Привет!"
 
 
+def _mock_loaded_model(respx_mock, base_url: str) -> None:
+    # loaded model info: compute_budgets skips its wait-for-load polling
+    respx_mock.get(f"{base_url.rstrip('/')}/api/v0/models/qwen/qwen3-14b").mock(
+        return_value=Response(200, json={"id": "qwen/qwen3-14b", "state": "loaded", "loaded_context_length": 8192, "max_context_length": 32768})
+    )
+
+
 @pytest.mark.asyncio
-@respx.mock
-async def test_stream_cancel() -> None:
-    from packages.core import settings as settings_module
-    settings_module.get_settings.cache_clear()
-    import apps.api.main as api_main
-    importlib.reload(api_main)
-    app = api_main.app
-
-    base_url = str(api_main.settings.lmstudio_base_url or os.environ.get("LMSTUDIO_BASE_URL", "http://192.168.0.111:1234"))
-
-    # a slow endless generator mock
-    async def slow_stream(request):
+async def test_stream_cancel(api_app, api_client, lmstudio_mock, respx_mock) -> None:
+    from apps.api.main import ACTIVE_STREAMS
+    from packages.storage.models import Response as ResponseRow
+    from packages.storage.repo import session_scope
+
+    _, st = api_app
+    base_url = str(st.lmstudio_base_url)
+    first_sent = asyncio.Event()
+    release = asyncio.Event()
+
+    # gated mock: one delta, then the upstream blocks until the test releases it
+    async def gated_stream(request):
         async def aiter():
-            while True:
-                yield b"data: {\"choices\":[{\"delta\":{\"content\":\"x\"}}]}\n\n"
-                await asyncio.sleep(0.2)
+            yield _X_DELTA
+            first_sent.set()
+            await release.wait()
+            yield _X_DELTA
+            yield _DONE
         return Response(200, content=aiter())
 
-    respx.post(f"{base_url.rstrip('/')}/v1/chat/completions").mock(side_effect=slow_stream)
+    lmstudio_mock(base_url, side_effect=gated_stream)
+    _mock_loaded_model(respx_mock, base_url)
 
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        payload = {"model": "lm:qwen/qwen3-14b", "input": "hi"}
-        # start stream in background
-        stream_task = asyncio.create_task(collect_sse_bytes(ac, "/responses?stream=true", body=payload))
-        await asyncio.sleep(0.5)
-        # Since we don't capture resp_id from meta here, just exercise cancel endpoint
-        r = await ac.post("/responses/resp_dummy/cancel")
-        assert r.status_code in (200, 404)
-        # cancel the stream task to finish test
-        stream_task.cancel()
-        with pytest.raises(asyncio.CancelledError):
-            await stream_task
+    payload = {"model": "lm:qwen/qwen3-14b", "input": "hi"}
+    async with asyncio.timeout(10):
+        async with asyncio.TaskGroup() as tg:
+            stream_task = tg.create_task(collect_sse_bytes(api_client, "/responses?stream=true", body=payload))
+            await first_sent.wait()  # the server has pulled the first delta; the stream is in flight
+            (resp_id,) = ACTIVE_STREAMS
+            r = await api_client.post(f"/responses/{resp_id}/cancel")
+            assert r.status_code == 200 and r.json() == {"status": "cancelling"}
+            release.set()
+    events = parse_events(stream_task.result())
+
+    # the fragment after the cancel is dropped; the stream still closes with a cancelled done
+    assert [d["text"] for n, d in events if n == "delta"] == ["x"]
+    assert events[-1] == ("done", {"status": "cancelled"})
+    # server side: stream unregistered, response stored as cancelled
+    assert resp_id not in ACTIVE_STREAMS
+    assert (await api_client.post(f"/responses/{resp_id}/cancel")).status_code == 404
+    with session_scope() as s:
+        assert s.get(ResponseRow, resp_id).status == "cancelled"
+
+
+@pytest.mark.asyncio
+async def test_stream_heartbeat_ping(api_app, api_client, monkeypatch, lmstudio_mock, respx_mock) -> None:
+    _, st = api_app
+    base_url = str(st.lmstudio_base_url)
+    # RESPONSES_HEARTBEAT_SEC on the injected settings: ping within ~50ms instead of 10s
+    monkeypatch.setattr(st, "responses_heartbeat_sec", 0.05)
+
+    async def delayed_stream(request):
+        async def aiter():
+            await asyncio.sleep(0.3)
+            yield _X_DELTA
+            yield _DONE
+        return Response(200, content=aiter())
+
+    lmstudio_mock(base_url, side_effect=delayed_stream)
+    _mock_loaded_model(respx_mock, base_url)
+
+    payload = {"model": "lm:qwen/qwen3-14b", "input": "hi"}
+
+    async def read_all():
+        return [item async for item in iter_events(api_client, "/responses?stream=true", body=payload)]
+
+    events = await asyncio.wait_for(read_all(), timeout=5.0)
+    pings = [d for n, d in events if n == "ping"]
+    # pings go out while the upstream is silent, i.e. before the first delta
+    names = [n for n, _ in events]
+    assert pings and all("ts" in p for p in pings)
+    assert names.index("ping") < names.index("delta")
+    assert names[-1] == "done"
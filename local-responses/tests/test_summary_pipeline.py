@@ -1,44 +1,37 @@
 from __future__ import annotations
-import os, importlib
-import pytest, respx
-from httpx import Response, AsyncClient, ASGITransport
+import pytest
+from httpx import Response
 
-from packages.storage.repo import append_message, get_l2_for_thread
+from packages.storage.repo import append_messages_bulk, get_l2_for_thread
 
 @pytest.mark.asyncio
-@respx.mock
-async def test_summary_pipeline_tail_and_l2_creation(tmp_path):
-    base_url = os.environ.get("LMSTUDIO_BASE_URL", "http://127.0.0.1:1234")
-    os.environ["LMSTUDIO_BASE_URL"] = base_url
+async def test_summary_pipeline_tail_and_l2_creation(api_app, api_client, lmstudio_mock, respx_mock):
+    _, st = api_app
+    base_url = str(st.lmstudio_base_url)
 
-    # Reset settings singleton
-    from packages.core import settings as settings_module
-    settings_module.get_settings.cache_clear()
-
-    import apps.api.main as api_main
-    importlib.reload(api_main)
-    app = api_main.app
+    # loaded 4k window: the L1 cap is sized against it and compute_budgets skips load polling
+    respx_mock.get(f"{base_url.rstrip('/')}/api/v0/models/qwen/qwen3-14b").mock(
+        return_value=Response(200, json={"id": "qwen/qwen3-14b", "state": "loaded", "loaded_context_length": 4096, "max_context_length": 4096})
+    )
 
     # Mock LM Studio completion endpoint
-    respx.post(f"{base_url.rstrip('/')}/v1/chat/completions").mock(
-        return_value=Response(200, json={
-            "choices": [{"message": {"content": "assistant final"}}],
-            "usage": {"input_tokens": 50, "output_tokens": 10, "total_tokens": 60},
-        })
-    )
+    lmstudio_mock(base_url, json={
+        "choices": [{"message": {"content": "assistant final"}}],
+        "usage": {"input_tokens": 50, "output_tokens": 10, "total_tokens": 60},
+    })
 
-    # Build thread with 6 user->assistant pairs
+    # Build thread with 6 user->assistant pairs (~400 tokens each: more than the L1 cap holds)
     from packages.storage.repo import create_thread
     th = create_thread(title=None)
     long_user = "U" * 120
-    long_assistant = "A" * 600
-    for i in range(6):
-        append_message(th.id, "user", f"{long_user}{i}")
-        append_message(th.id, "assistant", f"{long_assistant}{i}")
-
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        r = await ac.post("/responses", json={"model": "lm:qwen/qwen3-14b", "input": "latest", "max_output_tokens": 64, "thread_id": th.id})
+    long_assistant = "A" * 1600
+    append_messages_bulk(th.id, [
+        row
+        for i in range(6)
+        for row in ({"role": "user", "content": f"{long_user}{i}"}, {"role": "assistant", "content": f"{long_assistant}{i}"})
+    ])
+
+    r = await api_client.post("/responses", json={"model": "lm:qwen/qwen3-14b", "input": "latest", "max_output_tokens": 64, "thread_id": th.id})
     assert r.status_code == 200
     meta = r.json().get("metadata", {})
     asm = meta.get("context_assembly", {})
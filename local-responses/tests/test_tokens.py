@@ -0,0 +1,91 @@
+# tests/test_tokens.py
+from __future__ import annotations
+
+import math
+
+import pytest
+
+from packages.core.settings import get_settings
+
+
+def test_approx_tokens_batch_matches_ceil():
+    from packages.utils.tokens import approx_tokens, approx_tokens_batch
+
+    texts = ["", None, "a", "abcd", "abcde", "x" * 401]
+    assert approx_tokens_batch(texts) == [0, 0, 1, 1, 2, 101]
+    assert approx_tokens_batch(texts) == [int(math.ceil(len(t or "") / 4)) for t in texts]
+    assert [approx_tokens(t) for t in texts] == approx_tokens_batch(texts)
+
+
+def test_json_dumps_compact_unicode():
+    import json
+    from packages.utils.tokens import json_dumps
+
+    for obj in ({"b": 1, "a": ["й", None, True]}, [{"x": {"y": 2}}], {1: "a"}, {"n": 2**70}):
+        assert json_dumps(obj) == json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def test_json_dumps_floats_and_nan_independent_of_orjson():
+    import json
+    from packages.utils import tokens
+
+    obj = {"a": 1e-7, "b": float("nan"), "c": 1e16, "d": float("inf"), "e": 0.3}
+    assert tokens.json_dumps(obj) == json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    assert tokens.json_dumps(obj) == '{"a":1e-07,"b":NaN,"c":1e+16,"d":Infinity,"e":0.3}'
+
+
+def test_json_loads_bytes_and_errors(monkeypatch):
+    from packages.utils import tokens
+
+    raw = '{"choices":[{"delta":{"content":"Привет"}}]}'
+    for orjson_mod in (tokens.orjson, None):  # C path and stdlib fallback agree
+        monkeypatch.setattr(tokens, "orjson", orjson_mod)
+        assert tokens.json_loads(raw) == tokens.json_loads(raw.encode()) == {"choices": [{"delta": {"content": "Привет"}}]}
+        with pytest.raises(ValueError):
+            tokens.json_loads(b"{x")
+
+
+def test_estimate_tokens_falls_back_to_approx(monkeypatch):
+    from packages.utils import tokens
+
+    monkeypatch.setattr(tokens, "tiktoken", None)
+    tokens._bpe_encoder.cache_clear()
+    tokens.clear_estimate_cache()
+    try:
+        assert tokens.estimate_tokens("x" * 401) == tokens.approx_tokens("x" * 401) == 101
+        assert tokens.estimate_tokens("") == 0
+    finally:
+        tokens._bpe_encoder.cache_clear()
+        tokens.clear_estimate_cache()
+
+
+async def test_estimate_tokens_bpe_cache_and_units(monkeypatch):
+    from functools import lru_cache
+    from packages.utils import tokens
+    from packages.orchestration.token_budget import tokens_breakdown
+
+    calls = []
+
+    class WordEncoder:  # stand-in BPE: one token per word
+        def encode(self, text, disallowed_special=()):
+            calls.append(text)
+            return text.split()
+
+    monkeypatch.setattr(get_settings(), "TOKEN_COUNT_MODE", "approx")
+    monkeypatch.setattr(tokens, "tiktoken", object())
+    monkeypatch.setattr(tokens, "_bpe_encoder", lru_cache(maxsize=1)(WordEncoder))
+    tokens.clear_estimate_cache()
+    try:
+        await tokens.load_bpe_encoder()
+        assert tokens._bpe_encoder.cache_info().currsize == 1  # loaded before any count
+        long_text = "word " * 5000
+        assert tokens.estimate_tokens(long_text) == tokens.estimate_tokens(long_text) == 5000
+        assert len(calls) == 1
+        assert all(isinstance(k, bytes) and len(k) == 16 for k in tokens._estimate_cache)
+        # L1 blocks are counted in the same units as core/tools
+        bd = tokens_breakdown("m", {"system": [{"role": "system", "content": "a b c"}],
+                                    "l1": [{"role": "user", "content": "d e"}], "user": []})
+        assert bd["system"] == 3 and bd["l1"] == 2
+        assert tokens.estimate_tokens_batch(["d e", ""]) == [2, 0]
+    finally:
+        tokens.clear_estimate_cache()
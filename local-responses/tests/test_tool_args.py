@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import hashlib
+
+from packages.utils.tools import args_hash, canon_args
+
+
+def test_args_hash_stable_across_key_order_and_algos():
+    a = {"b": [1, {"y": 2, "x": 1}], "a": "тест"}
+    b = {"a": "тест", "b": [1, {"x": 1, "y": 2}]}
+    assert canon_args(a) == canon_args(b) == '{"a":"тест","b":[1,{"x":1,"y":2}]}'
+    raw = canon_args(a).encode("utf-8")
+    assert args_hash(a) == args_hash(b) == hashlib.sha256(raw).hexdigest()
+    assert args_hash(a, "blake2b") == hashlib.blake2b(raw).hexdigest()
+    assert args_hash(a, "md5") == hashlib.md5(raw).hexdigest()  # falls back to hashlib.new
+
+
+def test_canon_args_bytes_matches_stdlib_json():
+    import json
+    from packages.utils.tools import canon_args_bytes
+
+    obj = {"z": 1.5, "a": [True, None, "ё"], "n": {"k": 2**70}, "m": {"b": 0, "a": -1}}
+    expected = json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    assert canon_args_bytes(obj) == expected
+
+
+def test_canon_args_floats_and_nan_independent_of_orjson():
+    import json
+    import math
+    from packages.utils import tools
+
+    assert not hasattr(tools, "orjson")  # hashing never takes the optional encoder
+    for v in (1e-7, 1e16, float("nan"), float("inf")):
+        obj = {"v": v}
+        assert tools.canon_args_bytes(obj) == json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode()
+    assert tools.canon_args({"v": 1e-7}) == '{"v":1e-07}'
+    assert tools.canon_args({"v": 1e16}) == '{"v":1e+16}'
+    # NaN must not collapse into null: distinct args keep distinct cache keys
+    assert tools.args_hash({"v": math.nan}) != tools.args_hash({"v": None})